@@ -0,0 +1,110 @@
+import argparse
+import time
+from os import path
+
+import numpy as np
+import torch
+
+from transformers import AutoTokenizer, DataCollatorWithPadding
+
+from utils import DataHelper
+from inference import infer, make_dataloader
+from model.backends import COMPILE_BUCKETS, load_model, serialized_size
+from model.metric import klue_re_auprc, klue_re_micro_f1
+
+
+def first_batch_seconds(model, dataset, args, collate_fn):
+    """
+    latency of the first batch a freshly loaded model sees
+    """
+    dataloader, _ = make_dataloader(dataset, args.batch_size, collate_fn, args.max_tokens)
+    data = next(iter(dataloader))
+    start = time.perf_counter()
+    with torch.no_grad():
+        model(input_ids=data['input_ids'], attention_mask=data['attention_mask'])
+    return time.perf_counter() - start
+
+
+def evaluate(model, dataset, args, collate_fn):
+    """
+    steady state speed and metrics of one pass over the dataset
+    """
+    start = time.perf_counter()
+    preds, probs = infer(
+        model=model,
+        test_dataset=dataset,
+        batch_size=args.batch_size,
+        collate_fn=collate_fn,
+        device=torch.device('cpu'),
+        max_tokens=args.max_tokens
+    )
+    elapsed = time.perf_counter() - start
+    labels = dataset.labels if dataset.indices is None else dataset.labels[dataset.indices]
+    probs = np.asarray(probs, dtype=np.float32)
+    return {
+        'seconds': elapsed,
+        'sentences/s': len(dataset) / elapsed,
+        'micro f1': klue_re_micro_f1(np.asarray(preds), labels),
+        'auprc': klue_re_auprc(probs, labels),
+        'probs': probs,
+    }
+
+
+def benchmark(args):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
+    helper = DataHelper(data_dir=args.data_dir, mode='train', add_ent_token=args.add_ent_token)
+    dataset = helper.to_dataset(tokenizer)
+    if args.n_samples:
+        dataset = dataset.select(np.arange(min(args.n_samples, len(dataset))))
+    print(f'{len(dataset)} labeled sentences, {torch.get_num_threads()} intra-op threads, cpu')
+
+    results = {}
+    for backend in ['fp32'] + [backend for backend in args.backends if backend != 'fp32']:
+        start = time.perf_counter()
+        model = load_model(args.model_dir, backend, buckets=args.buckets)
+        load_seconds = time.perf_counter() - start
+        first_batch = first_batch_seconds(model, dataset, args, data_collator)
+        results[backend] = evaluate(model, dataset, args, data_collator)
+        results[backend]['load seconds'] = load_seconds
+        results[backend]['first prediction seconds'] = load_seconds + first_batch
+        results[backend]['size MB'] = serialized_size(model) / 1024 ** 2
+        del model
+
+    base = results['fp32']
+    for backend, result in results.items():
+        print(f'{backend:>11}: load {result["load seconds"]:6.1f}s  '
+              f'first prediction {result["first prediction seconds"]:6.1f}s  '
+              f'{result["sentences/s"]:8.1f} sentences/s (x{result["sentences/s"] / base["sentences/s"]:.2f})  '
+              f'{result["size MB"]:8.1f} MB (x{base["size MB"] / result["size MB"]:.2f} smaller)  '
+              f'micro f1 {result["micro f1"]:6.2f} ({result["micro f1"] - base["micro f1"]:+.2f})  '
+              f'auprc {result["auprc"]:6.2f} ({result["auprc"] - base["auprc"]:+.2f})  '
+              f'max |probs diff| {np.abs(result["probs"] - base["probs"]).max():.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='cpu load time, time to first prediction, steady state speed, model size and '
+                    'KLUE-RE micro f1 / auprc of inference backends against fp32')
+
+    parser.add_argument('--data_dir', type=str, default='data/train.csv',
+                        help='labeled csv, the metrics need gold labels')
+    parser.add_argument('--model_dir', type=str, default=path.join('best_model', 'plain'))
+    parser.add_argument('--model_name', type=str, default='klue/bert-base')
+    parser.add_argument('--backends', type=str, nargs='+', default=['quantized'],
+                        choices=['fp32', 'quantized', 'onnx', 'torchscript'])
+    parser.add_argument('--buckets', type=int, nargs='+', default=list(COMPILE_BUCKETS),
+                        help='sequence lengths the torchscript backend pads batches to')
+    parser.add_argument('--n_samples', type=int, default=1000,
+                        help='evaluate the first n rows, 0 for all')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--max_tokens', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=0,
+                        help='intra-op threads, 0 keeps the torch default')
+    parser.add_argument('--add_ent_token', type=bool, default=True)
+
+    args = parser.parse_args()
+    print(args)
+
+    benchmark(args=args)
@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import time
+
+import aiohttp
+import numpy as np
+import pandas as pd
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q)) * 1000 if len(latencies) else float('nan')
+
+
+async def send(session, url, body, deadline_ms):
+    headers = {'X-Deadline-Ms': str(deadline_ms)} if deadline_ms else {}
+    start = time.perf_counter()
+    try:
+        async with session.post(url, json=body, headers=headers) as response:
+            await response.read()
+            status = response.status
+    except aiohttp.ClientError:
+        status = -1
+    return status, time.perf_counter() - start
+
+
+async def open_loop(session, url, bodies, rate, duration, deadline_ms, rng):
+    """
+    requests at Poisson arrivals of `rate` per second for `duration` seconds, each sent without waiting
+    for earlier ones, so a slow server faces the full offered load like it would from many callers
+    """
+    tasks = []
+    start = time.perf_counter()
+    arrival = 0.0
+    while arrival < duration:
+        delay = start + arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        body = bodies[rng.integers(len(bodies))]
+        tasks.append(asyncio.ensure_future(send(session, url, body, deadline_ms)))
+        arrival += rng.exponential(1 / rate)
+    return await asyncio.gather(*tasks)
+
+
+def report(rate, duration, results):
+    status = np.array([status for status, _ in results])
+    latency = np.array([latency for _, latency in results])
+    ok, shed, expired = latency[status == 200], latency[status == 503], latency[status == 504]
+    other = len(results) - len(ok) - len(shed) - len(expired)
+    print(f'offered {rate:7.1f}/s  goodput {len(ok) / duration:7.1f}/s  '
+          f'ok p50 {percentile_ms(ok, 50):7.1f} ms  p99 {percentile_ms(ok, 99):7.1f} ms  '
+          f'shed {len(shed) / len(results):6.1%} (p99 {percentile_ms(shed, 99):6.1f} ms)  '
+          f'expired {len(expired) / len(results):6.1%}  errors {other}')
+
+
+async def benchmark(args):
+    data = pd.read_csv(args.data_dir).head(args.n_samples)
+    bodies = [
+        {'sentence': row.sentence, 'subject_entity': row.subject_entity, 'object_entity': row.object_entity}
+        for row in data.itertuples()
+    ]
+    rng = np.random.default_rng(args.seed)
+    url = f'http://{args.host}:{args.port}'
+
+    # no client side connection limit, queueing must happen at the server
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        for rate in args.rates:
+            results = await open_loop(
+                session, url + '/predict', bodies, rate, args.duration, args.deadline_ms, rng)
+            report(rate, args.duration, results)
+        async with session.get(url + '/stats') as response:
+            print(f'server stats: {await response.json()}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='open loop load generator for serve.py: goodput, latency and shed / expired requests '
+                    'at increasing offered rates. run it against a server started with its default admission '
+                    'limits and with --max_queue 0 --max_inflight_tokens 0 --deadline_ms 0 to compare')
+
+    parser.add_argument('--data_dir', type=str, default='data/test_data.csv')
+    parser.add_argument('--n_samples', type=int, default=1000)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--rates', type=float, nargs='+', default=[10, 50, 100, 200, 400],
+                        help='offered requests per second, one run each')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of load per rate')
+    parser.add_argument('--deadline_ms', type=float, default=0,
+                        help='X-Deadline-Ms of every request, 0 keeps the server default')
+    parser.add_argument('--seed', type=int, default=42)
+
+    args = parser.parse_args()
+    print(args)
+
+    asyncio.run(benchmark(args=args))
@@ -0,0 +1,92 @@
+import argparse
+from os import path
+
+import numpy as np
+
+from utils import load_label_codec, load_predictions, read_submission, save_predictions, write_submission
+
+
+def load(file, labels):
+    if path.splitext(file)[1] == '.npz':
+        return load_predictions(file)
+    return read_submission(file, labels)
+
+
+def align(predictions):
+    """
+    probs of every model as one [n_models, N, num_labels] float32 array, rows in the id order of the first
+    """
+    ids, labels = predictions[0].id, predictions[0].labels
+    probs = np.empty((len(predictions), len(ids), len(labels)), dtype=np.float32)
+    for i, prediction in enumerate(predictions):
+        if not np.array_equal(prediction.labels, labels):
+            raise ValueError(f'label space of input {i} differs from the first input')
+        if len(prediction.id) != len(ids):
+            raise ValueError(f'input {i} has {len(prediction.id)} rows, the first input has {len(ids)}')
+        rows = np.argsort(prediction.id)[np.argsort(np.argsort(ids))]
+        if not np.array_equal(prediction.id[rows], ids):
+            raise ValueError(f'ids of input {i} differ from the first input')
+        probs[i] = prediction.probs[rows]
+    return ids, labels, probs
+
+
+def rank(probs):
+    """
+    per model and class, each row's rank among all rows scaled to [0, 1]
+    """
+    ranks = np.argsort(np.argsort(probs, axis=1), axis=1).astype(np.float32)
+    return ranks / max(probs.shape[1] - 1, 1)
+
+
+def combine(probs, weights, method):
+    weights = np.asarray(weights, dtype=np.float32)
+    weights = weights / weights.sum()
+    if method == 'geometric':
+        scores = np.exp(np.tensordot(weights, np.log(np.clip(probs, 1e-12, None)), axes=1))
+    elif method == 'rank':
+        scores = np.tensordot(weights, rank(probs), axes=1)
+    else:
+        scores = np.tensordot(weights, probs, axes=1)
+    # geometric and rank scores are not distributions, renormalize so every row sums to 1
+    return scores / scores.sum(axis=-1, keepdims=True)
+
+
+def ensemble(args):
+    labels = load_label_codec(args.dictionary).labels
+    ids, labels, probs = align([load(file, labels) for file in args.inputs])
+
+    if args.method == 'weighted' and not args.weights:
+        raise ValueError('--method weighted needs --weights')
+    weights = args.weights or np.ones(len(args.inputs))
+    if len(weights) != len(args.inputs):
+        raise ValueError(f'{len(weights)} weights for {len(args.inputs)} inputs')
+
+    probs = combine(probs, weights, args.method)
+    if path.splitext(args.output)[1] == '.npz':
+        save_predictions(args.output, ids, probs, labels, dtype=args.probs_dtype)
+    else:
+        write_submission(args.output, ids, probs, labels)
+    print(f'{args.method} ensemble of {len(args.inputs)} models saved to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='combine saved per model predictions (.npz or submission csv) without running any model')
+
+    parser.add_argument('inputs', type=str, nargs='+')
+    parser.add_argument('--output', type=str,
+                        default='./prediction/ensemble_submission.csv',
+                        help='.npz for binary output, anything else is written as a submission csv')
+    parser.add_argument('--method', type=str, default='mean',
+                        choices=['mean', 'weighted', 'geometric', 'rank'])
+    parser.add_argument('--weights', type=float, nargs='+', default=[],
+                        help='one weight per input, required by --method weighted, also applied by geometric and rank')
+    parser.add_argument('--dictionary', type=str,
+                        default='data/dict_num_to_label.pkl',
+                        help='label space of csv inputs, npz inputs carry their own')
+    parser.add_argument('--probs_dtype', type=str, default='float32', choices=['float16', 'float32'])
+
+    args = parser.parse_args()
+    print(args)
+
+    ensemble(args=args)
@@ -0,0 +1,65 @@
+import argparse
+import sys
+from os import path
+
+import torch
+
+from transformers import AutoModelForSequenceClassification
+
+from model.backends import ONNX_NAME, ONNX_OPSET, OnnxModel, export_onnx, max_logit_diff
+
+
+def check_batches(vocab_size, seed=42):
+    """
+    (input_ids, attention_mask) batches of other batch sizes and lengths than the export example,
+    every other row padded, so the dynamic axes and the masking are both exercised
+    """
+    generator = torch.Generator().manual_seed(seed)
+    batches = []
+    for batch_size, seq_len in [(1, 7), (3, 32), (8, 128), (16, 256)]:
+        input_ids = torch.randint(5, vocab_size, (batch_size, seq_len), generator=generator)
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[1::2, seq_len // 2:] = 0
+        batches.append((input_ids, attention_mask))
+    return batches
+
+
+def export(args):
+    model_dirs = [
+        path.join(args.model_dir, f'{k}_fold') for k in range(args.n_splits)
+    ] if args.mode == 'skf' else [path.join(args.model_dir, args.mode)]
+
+    failed = []
+    for model_dir in model_dirs:
+        onnx_file = export_onnx(model_dir, opset=args.opset, optimize=args.optimize)
+
+        model = AutoModelForSequenceClassification.from_pretrained(model_dir).eval()
+        onnx_model = OnnxModel.from_pretrained(model_dir)
+        diff = max_logit_diff(model, onnx_model, check_batches(model.config.vocab_size))
+        print(f'{onnx_file}: max |logits diff| against pytorch {diff:.2e} (atol {args.atol:.0e})')
+        if diff > args.atol:
+            failed.append(model_dir)
+
+    if failed:
+        sys.exit(f'onnx outputs of {failed} differ from pytorch by more than {args.atol}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=f'export fold checkpoints to <model_dir>/<fold>/{ONNX_NAME} for inference.py --backend onnx')
+
+    parser.add_argument('--model_dir', type=str, default='./best_model')
+    parser.add_argument('--mode', type=str, default='skf',
+                        choices=['plain', 'skf'])
+    parser.add_argument('--n_splits', type=int, default=5)
+    parser.add_argument('--opset', type=int, default=ONNX_OPSET,
+                        help='onnx opset, 17 by default (12 before torch 1.13)')
+    parser.add_argument('--no_optimize', dest='optimize', action='store_false',
+                        help='skip fusing attention, gelu and layer norms with the onnxruntime transformer optimizer')
+    parser.add_argument('--atol', type=float, default=1e-4,
+                        help='largest logit difference to pytorch accepted')
+
+    args = parser.parse_args()
+    print(args)
+
+    export(args=args)
@@ -22,7 +22,7 @@ tokenizer = AutoTokenizer.from_pretrained(
 data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
 
 helper = DataHelper(data_dir='data/train.csv', mode='train',
-                    add_ent_token=True, aug_data_dir='')
+                    add_ent_token=True, add_data_dir='')
 train_idxs, val_idxs = helper.split(ratio=0.1, n_splits=5, mode='plain')[0]
 
 train_data, train_labels = helper.from_idxs(idxs=train_idxs)
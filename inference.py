@@ -1,21 +1,68 @@
 import argparse
+import tempfile
 from os import path
 
 import torch
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
 
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, DataCollatorWithPadding
+from transformers import AutoTokenizer, DataCollatorWithPadding
 import pandas as pd
+import numpy as np
 from tqdm import tqdm
 
 from utils import *
-
-
-def infer(model, test_dataset, batch_size, collate_fn, device):
-    dataloader = DataLoader(
-        test_dataset, batch_size=batch_size, collate_fn=collate_fn, shuffle=False)
-    preds, probs = [], []
+from model.ensemble import FoldEnsemble
+from model.backends import COMPILE_BUCKETS, load_model
+
+
+def token_budget_batches(lengths, max_tokens):
+    """
+    Batches of indices sorted from the longest to the shortest sentence,
+    each padded batch (longest * size) fits in max_tokens
+    """
+    lengths = np.asarray(lengths)
+    batches, batch = [], []
+    for idx in np.argsort(-lengths, kind='stable').tolist():
+        # sorted longest first, so the first index of a batch sets its padded length
+        if batch and lengths[batch[0]] * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def make_dataloader(test_dataset, batch_size, collate_fn, max_tokens=0):
+    """
+    returns the dataloader and the dataset index of every row it yields, in order
+    """
+    if max_tokens:
+        batches = token_budget_batches(test_dataset.lengths(), max_tokens)
+        dataloader = DataLoader(
+            test_dataset, batch_sampler=batches, collate_fn=collate_fn)
+        order = [idx for batch in batches for idx in batch]
+    else:
+        dataloader = DataLoader(
+            test_dataset, batch_size=batch_size, collate_fn=collate_fn, shuffle=False)
+        order = None
+    return dataloader, order
+
+
+def infer(model, test_dataset, batch_size, collate_fn, device, max_tokens=0):
+    """
+    returns preds [N] and probs [N, num_labels] as numpy arrays in the dataset order
+    every batch is copied into preallocated arrays as it finishes, so memory stays at
+    one float32 row per sentence instead of growing lists of python floats or device tensors
+    """
+    dataloader, order = make_dataloader(
+        test_dataset, batch_size, collate_fn, max_tokens)
+    order = np.arange(len(test_dataset)) if order is None else np.asarray(order)
+    preds = np.zeros(len(test_dataset), dtype=np.int64)
+    probs = np.zeros((len(test_dataset), model.config.num_labels), dtype=np.float32)
+
+    start = 0
     model.eval()
     for data in tqdm(dataloader):
         with torch.no_grad():
@@ -24,73 +71,120 @@ def infer(model, test_dataset, batch_size, collate_fn, device):
                 attention_mask=data['attention_mask'].to(device)
             )
         logits = outputs[0]
-        result = torch.argmax(logits, dim=-1)
-        prob = F.softmax(logits, dim=-1)
+        rows = order[start: start + len(logits)]
+        start += len(rows)
+
+        preds[rows] = torch.argmax(logits, dim=-1).cpu().numpy()
+        probs[rows] = F.softmax(logits, dim=-1).float().cpu().numpy()
+
+    return preds, probs
+
+
+def infer_folds(ensemble, test_dataset, batch_size, collate_fn, device, max_tokens=0, fold_outputs=None):
+    """
+    one pass over the test set through every fold of a FoldEnsemble
+    fold probs are folded into a preallocated float32 running mean as each batch finishes,
+    and written to fold_outputs[k] (arrays of [N, num_labels], e.g. .npy memmaps) when given
+    returns the fold averaged probs [N, num_labels]
+    """
+    dataloader, order = make_dataloader(
+        test_dataset, batch_size, collate_fn, max_tokens)
+    order = np.arange(len(test_dataset)) if order is None else np.asarray(order)
+    probs = np.zeros((len(test_dataset), ensemble.num_labels), dtype=np.float32)
 
-        preds.append(result)
-        probs.append(prob)
+    start = 0
+    ensemble.eval()
+    for data in tqdm(dataloader):
+        with torch.no_grad():
+            _, fold_probs = ensemble(
+                input_ids=data['input_ids'].to(device),
+                attention_mask=data['attention_mask'].to(device)
+            )
+        fold_probs = fold_probs.float().cpu().numpy()
+        rows = order[start: start + fold_probs.shape[1]]
+        start += len(rows)
 
-    return torch.cat(preds).tolist(), torch.cat(probs, dim=0).tolist()
+        mean = probs[rows]
+        for k, prob in enumerate(fold_probs):
+            mean += (prob - mean) / (k + 1)
+            if fold_outputs is not None:
+                fold_outputs[k][rows] = prob
+        probs[rows] = mean
+
+    return probs
 
 
 def inference(args):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    device = torch.device(
+        'cuda' if torch.cuda.is_available() and args.backend in ('fp32', 'torchscript') else 'cpu')
 
     tokenizer = AutoTokenizer.from_pretrained(args.model_name)
     data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
 
     helper = DataHelper(data_dir=args.data_dir,
-                        mode='inference', add_ent_token=args.add_ent_token)
+                        mode='inference', add_ent_token=args.add_ent_token,
+                        num_workers=args.num_workers)
     _test_data = helper.from_idxs()
     test_data = helper.tokenize(data=_test_data, tokenizer=tokenizer)
     test_dataset = RelationExtractionDataset(test_data)
+    label_codec = load_label_codec(args.dictionary)
+
+    def save_output(name, probs):
+        if args.output_format == 'csv':
+            write_submission(path.join(args.output_dir, name + '_submission.csv'),
+                             _test_data['id'], probs, label_codec.labels)
+            return
+        predictions = path.join(args.output_dir, name + '.npz')
+        save_predictions(predictions, _test_data['id'], probs,
+                         label_codec.labels, dtype=args.probs_dtype)
+        if args.submission:
+            predictions_to_submission(
+                predictions, path.join(args.output_dir, name + '_submission.csv'))
 
-    probs = []
-    for k in range(args.n_splits if args.mode == 'skf' else 1):
-        model = AutoModelForSequenceClassification.from_pretrained(
-            path.join(args.model_dir,
-                      f'{k}_fold' if args.mode == 'skf' else args.mode)
-        )
-        model.to(device)
-
-        pred_labels, pred_probs = infer(
+    if args.mode == 'skf':
+        # every fold stays resident and sees each batch, the test set is read once
+        model_dirs = [path.join(args.model_dir, f'{k}_fold') for k in range(args.n_splits)]
+        if args.backend == 'fp32':
+            ensemble = FoldEnsemble.from_pretrained(model_dirs, device)
+        else:
+            # packed int8 weights, onnx sessions and traced graphs can not be stacked, the folds run one after another
+            ensemble = FoldEnsemble(
+                [load_model(model_dir, args.backend, device, args.buckets) for model_dir in model_dirs],
+                stack=False)
+        # the fold memmaps are only streaming buffers for the outputs, removed with their directory
+        with tempfile.TemporaryDirectory(dir=args.output_dir) as buffer_dir:
+            fold_outputs = [
+                np.lib.format.open_memmap(
+                    path.join(buffer_dir, f'{k}_fold_probs.npy'), mode='w+',
+                    dtype=np.float32, shape=(len(test_dataset), ensemble.num_labels))
+                for k in range(args.n_splits)
+            ]
+            probs = infer_folds(
+                ensemble=ensemble,
+                test_dataset=test_dataset,
+                batch_size=args.batch_size,
+                collate_fn=data_collator,
+                device=device,
+                max_tokens=args.max_tokens,
+                fold_outputs=fold_outputs
+            )
+            for k, fold_probs in enumerate(fold_outputs):
+                save_output(f'{k}_fold', fold_probs)
+            # unmapped before the directory is removed
+            del fold_outputs, fold_probs
+        save_output(f'{args.n_splits}_folds', probs)
+    else:
+        model = load_model(path.join(args.model_dir, args.mode), args.backend, device, args.buckets)
+
+        _, probs = infer(
             model=model,
             test_dataset=test_dataset,
             batch_size=args.batch_size,
             collate_fn=data_collator,
-            device=device
-        )
-        pred_labels = helper.convert_labels_by_dict(
-            labels=pred_labels,
-            dictionary=args.dictionary
-        )
-        probs.append(pred_probs)
-
-        output = pd.DataFrame({
-            'id': _test_data['id'],
-            'pred_label': pred_labels,
-            'probs': pred_probs
-        })
-        output.to_csv(
-            path.join(args.output_dir, (f'{k}_fold' if args.mode ==
-                      'skf' else args.mode) + '_submission.csv'),
-            index=False
-        )
-
-    if args.mode == 'skf':
-        probs = torch.tensor(probs).mean(dim=0)
-        preds = torch.argmax(probs, dim=-1).tolist()
-        preds = helper.convert_labels_by_dict(
-            labels=preds,
-            dictionary=args.dictionary
+            device=device,
+            max_tokens=args.max_tokens
         )
-        output = pd.DataFrame({
-            'id': _test_data['id'],
-            'pred_label': preds,
-            'probs': probs.tolist()
-        })
-        output.to_csv(path.join(args.output_dir,
-                      f'{args.n_splits}_folds_submission.csv'), index=False)
+        save_output(args.mode, probs)
 
     print('Inference done')
 
@@ -109,7 +203,22 @@ if __name__ == '__main__':
                         choices=['plain', 'skf'])
     parser.add_argument('--n_splits', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--max_tokens', type=int, default=0,
+                        help='pack length-sorted batches up to this many padded tokens instead of --batch_size')
     parser.add_argument('--add_ent_token', type=bool, default=True)
+    parser.add_argument('--backend', type=str, default='fp32', choices=['fp32', 'quantized', 'onnx', 'torchscript'],
+                        help='quantized: dynamic INT8 Linear layers on cpu, cached under cache/quantized, '
+                             'onnx: onnxruntime on the model.onnx written by export_onnx.py, '
+                             'torchscript: traced once per fold, cached under cache/compiled, batches padded to --buckets lengths')
+    parser.add_argument('--buckets', type=int, nargs='+', default=list(COMPILE_BUCKETS),
+                        help='sequence lengths the torchscript backend is checked and warmed up at, batches are padded up to the next one')
+    parser.add_argument('--output_format', type=str, default='csv', choices=['csv', 'npz'],
+                        help='npz writes ids, label indices and probs as binary columns, read back with utils.load_predictions')
+    parser.add_argument('--probs_dtype', type=str, default='float32', choices=['float16', 'float32'])
+    parser.add_argument('--submission', action='store_true',
+                        help='with --output_format npz, also render the submission csv from the npz')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='processes for entity marking and tokenization of large test files')
 
     args = parser.parse_args()
     print(args)
@@ -0,0 +1,306 @@
+import hashlib
+import inspect
+import io
+import json
+import os
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    # torch < 1.10, the pinned 1.7.1 among them
+    from torch.quantization import quantize_dynamic
+
+from packaging import version
+import transformers
+from transformers import AutoConfig, AutoModelForSequenceClassification
+
+from model.stacking import checkpoint_signature
+
+
+def serialized_size(model):
+    """
+    Bytes of the model's state_dict as torch.save writes it, of the .onnx file for onnx models
+    """
+    if isinstance(model, OnnxModel):
+        return os.path.getsize(model.onnx_file)
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def quantize(model):
+    """
+    Dynamic INT8 quantization of every nn.Linear (weights int8, activations quantized per batch), cpu only
+    """
+    return quantize_dynamic(model.cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+class QuantizedCache:
+    """
+    On-disk store of dynamically quantized fold models, one state_dict per checkpoint
+    a checkpoint retrained in place changes its signature and so the key
+    """
+
+    def __init__(self, cache_dir="cache/quantized"):
+        self.cache_dir = cache_dir
+
+    def key(self, model_dir):
+        description = {
+            "version": 1,
+            "model": (os.path.abspath(model_dir), checkpoint_signature(model_dir)),
+            "torch": torch.__version__,
+            "scheme": "dynamic qint8 nn.Linear",
+        }
+        return hashlib.sha1(
+            json.dumps(description, sort_keys=True).encode()
+        ).hexdigest()
+
+    def load(self, model_dir):
+        """
+        The quantized model of model_dir, quantized and cached on first use
+        """
+        entry = os.path.join(self.cache_dir, self.key(model_dir) + ".pt")
+        if os.path.isfile(entry):
+            # quantize an uninitialized copy to get the packed layout, then fill in the cached weights
+            model = quantize(AutoModelForSequenceClassification.from_config(
+                AutoConfig.from_pretrained(model_dir)))
+            model.load_state_dict(torch.load(entry, map_location="cpu"))
+            return model
+
+        model = quantize(AutoModelForSequenceClassification.from_pretrained(model_dir))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = os.path.join(self.cache_dir, f".{os.path.basename(entry)}.{os.getpid()}.tmp")
+        torch.save(model.state_dict(), tmp)
+        os.replace(tmp, entry)
+        return model
+
+
+ONNX_NAME = "model.onnx"
+# opset 17 needs torch 1.13, older torch gets 12, the newest the pinned 1.7.1 exports
+ONNX_OPSET = 17 if version.parse(torch.__version__) >= version.parse("1.13") else 12
+
+
+def export_onnx(model_dir, onnx_file=None, opset=ONNX_OPSET, optimize=True):
+    """
+    Export a fold checkpoint to ONNX with dynamic batch and sequence axes, by default next to it
+    optimize: fuse attention, gelu and layer norms with the onnxruntime transformer optimizer
+    returns the onnx file
+    """
+    onnx_file = onnx_file or os.path.join(model_dir, ONNX_NAME)
+    load_kwargs, export_kwargs = {}, {}
+    if version.parse(transformers.__version__) >= version.parse("4.36"):
+        # eager attention exports the matmul / softmax pattern the attention fusion matches,
+        # older transformers only have that attention
+        load_kwargs["attn_implementation"] = "eager"
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # newer torch defaults to the dynamo exporter, keep the TorchScript one of older releases
+        export_kwargs["dynamo"] = False
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir, **load_kwargs).eval()
+    input_ids = torch.randint(5, model.config.vocab_size, (2, 16))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 8:] = 0
+    axes = {0: "batch", 1: "sequence"}
+    torch.onnx.export(
+        model, (input_ids, attention_mask), onnx_file,
+        input_names=["input_ids", "attention_mask"], output_names=["logits"],
+        dynamic_axes={"input_ids": axes, "attention_mask": axes, "logits": {0: "batch"}},
+        opset_version=opset, **export_kwargs)
+
+    if optimize:
+        from onnxruntime.transformers.optimizer import optimize_model
+        optimized = optimize_model(
+            onnx_file, model_type="bert",
+            num_heads=model.config.num_attention_heads, hidden_size=model.config.hidden_size)
+        fused = {op: n for op, n in optimized.get_fused_operator_statistics().items() if n}
+        print(f"{onnx_file}: fused {fused}")
+        optimized.save_model_to_file(onnx_file)
+    return onnx_file
+
+
+class OnnxModel(nn.Module):
+    """
+    onnxruntime cpu session of an exported fold model with all graph optimizations enabled
+    called like the torch model, returns (logits,) so infer and FoldEnsemble take it as is
+    """
+
+    def __init__(self, onnx_file, config, threads=None):
+        super(OnnxModel, self).__init__()
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            onnx_file, options, providers=["CPUExecutionProvider"])
+        self.onnx_file = onnx_file
+        self.config = config
+
+    @classmethod
+    def from_pretrained(cls, model_dir, threads=None):
+        onnx_file = os.path.join(model_dir, ONNX_NAME)
+        if not os.path.isfile(onnx_file):
+            raise FileNotFoundError(
+                f"{onnx_file} not found, export the checkpoint first: python export_onnx.py --model_dir ...")
+        return cls(onnx_file, AutoConfig.from_pretrained(model_dir), threads=threads)
+
+    def forward(self, input_ids, attention_mask=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        logits = self.session.run(["logits"], {
+            "input_ids": input_ids.cpu().numpy(),
+            "attention_mask": attention_mask.cpu().numpy(),
+        })[0]
+        return (torch.from_numpy(logits),)
+
+
+def max_logit_diff(model, other, batches):
+    """
+    Largest absolute logit difference of two models over (input_ids, attention_mask) batches
+    """
+    diff = 0.0
+    with torch.no_grad():
+        for input_ids, attention_mask in batches:
+            diff = max(diff, (
+                model(input_ids=input_ids, attention_mask=attention_mask)[0].float()
+                - other(input_ids=input_ids, attention_mask=attention_mask)[0].float()
+            ).abs().max().item())
+    return diff
+
+
+COMPILE_BUCKETS = (32, 64, 128, 256, 512)
+
+
+class _Logits(nn.Module):
+    """
+    Positional (input_ids, attention_mask) -> logits signature of a classifier, the form torch.jit.trace takes
+    """
+
+    def __init__(self, model):
+        super(_Logits, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+
+class BucketedModel(nn.Module):
+    """
+    A traced classifier fed bucketed lengths only: every batch is padded to the next bucket (pad tokens,
+    attention 0), so the TorchScript executor specializes and optimizes the graph for a handful of shapes.
+    returns (logits,) like the torch model
+    """
+
+    def __init__(self, graph, buckets, config):
+        super(BucketedModel, self).__init__()
+        self.graph = graph
+        self.buckets = sorted(buckets)
+        self.config = config
+
+    def pad(self, input_ids, attention_mask):
+        length = input_ids.shape[1]
+        bucket = next((bucket for bucket in self.buckets if bucket >= length), None)
+        if bucket is None:
+            raise ValueError(f"sequence length {length} is past the largest bucket {self.buckets[-1]}")
+        if bucket > length:
+            input_ids = F.pad(input_ids, (0, bucket - length), value=self.config.pad_token_id or 0)
+            attention_mask = F.pad(attention_mask, (0, bucket - length), value=0)
+        return input_ids, attention_mask
+
+    def warm_up(self, batch_size=2):
+        """
+        run every bucket once, the executor compiles its specializations here instead of on live batches
+        """
+        device = next(self.graph.parameters()).device
+        with torch.no_grad():
+            for length in self.buckets:
+                for _ in range(2):  # the profiling executor optimizes on the second run of a shape
+                    input_ids = torch.full((batch_size, length), 5, dtype=torch.long, device=device)
+                    self.graph(input_ids, torch.ones_like(input_ids))
+        return self
+
+    def forward(self, input_ids, attention_mask=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        return (self.graph(*self.pad(input_ids, attention_mask)),)
+
+
+class CompiledCache:
+    """
+    On-disk store of fold models traced to TorchScript, one graph per checkpoint
+    the trace is checked against the eager model at every bucketed length before it is stored,
+    a checkpoint retrained in place changes its signature and so the key
+    """
+
+    def __init__(self, cache_dir="cache/compiled", atol=1e-4):
+        self.cache_dir = cache_dir
+        self.atol = atol
+
+    def key(self, model_dir, buckets, device):
+        description = {
+            "version": 1,
+            "model": (os.path.abspath(model_dir), checkpoint_signature(model_dir)),
+            "buckets": sorted(buckets),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "device": torch.device(device).type,
+        }
+        return hashlib.sha1(
+            json.dumps(description, sort_keys=True).encode()
+        ).hexdigest()
+
+    def trace(self, model_dir, buckets, device):
+        model = _Logits(AutoModelForSequenceClassification.from_pretrained(model_dir).to(device).eval())
+
+        def example(length):
+            input_ids = torch.randint(5, model.model.config.vocab_size, (2, length), device=device)
+            attention_mask = torch.ones_like(input_ids)
+            attention_mask[1, length // 2:] = 0
+            return input_ids, attention_mask
+
+        with torch.no_grad():
+            graph = torch.jit.trace(model, example(max(buckets)))
+            for length in buckets:
+                inputs = example(length)
+                diff = (graph(*inputs) - model(*inputs)).abs().max().item()
+                if diff > self.atol:
+                    raise RuntimeError(
+                        f"traced {model_dir} differs from eager by {diff:.2e} at length {length}")
+        return graph
+
+    def load(self, model_dir, buckets=COMPILE_BUCKETS, device="cpu"):
+        """
+        The bucketed TorchScript model of model_dir, traced and cached on first use, warmed up
+        """
+        entry = os.path.join(self.cache_dir, self.key(model_dir, buckets, device) + ".pt")
+        if os.path.isfile(entry):
+            graph = torch.jit.load(entry, map_location=device)
+        else:
+            graph = self.trace(model_dir, buckets, device)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = os.path.join(self.cache_dir, f".{os.path.basename(entry)}.{os.getpid()}.tmp")
+            torch.jit.save(graph, tmp)
+            os.replace(tmp, entry)
+        return BucketedModel(graph, buckets, AutoConfig.from_pretrained(model_dir)).eval().warm_up()
+
+
+def load_model(model_dir, backend="fp32", device="cpu", buckets=COMPILE_BUCKETS):
+    """
+    A fine-tuned fold model for inference on the given backend
+    fp32: the checkpoint as trained, quantized: dynamic INT8 Linear layers on cpu, cached under cache/quantized
+    onnx: onnxruntime session of the model.onnx export_onnx wrote next to the checkpoint
+    torchscript: traced once, cached under cache/compiled, fed batches padded to bucketed lengths
+    """
+    if backend == "quantized":
+        return QuantizedCache().load(model_dir)
+    if backend == "onnx":
+        return OnnxModel.from_pretrained(model_dir)
+    if backend == "torchscript":
+        return CompiledCache().load(model_dir, buckets=buckets, device=device)
+    if backend != "fp32":
+        raise ValueError(f"unknown backend {backend}")
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+    return model.to(device).eval()
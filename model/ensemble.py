@@ -0,0 +1,94 @@
+import copy
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from transformers import AutoModelForSequenceClassification
+
+
+def torch_func():
+    """
+    The torch.func module (torch >= 2.0), None on older torch
+    """
+    try:
+        import torch.func
+    except ImportError:
+        return None
+    return torch.func
+
+
+def same_architecture(models):
+    """
+    Whether all models share one class, config and parameter layout, so their weights can be stacked
+    """
+    first = models[0]
+    shapes = {name: p.shape for name, p in first.state_dict().items()}
+    return all(
+        type(model) is type(first)
+        and model.config.to_diff_dict() == first.config.to_diff_dict()
+        and {name: p.shape for name, p in model.state_dict().items()} == shapes
+        for model in models[1:]
+    )
+
+
+class FoldEnsemble(nn.Module):
+    """
+    All fold models kept resident, every batch goes through every fold in a single pass over the data
+    folds with the same architecture are stacked into one set of parameters and run as a vmapped
+    functional call on a weightless copy of the first fold (needs torch.func), other folds, or every
+    fold on older torch, run one after another.
+    forward returns (log of the fold averaged probs, per fold probs [n_folds, batch, num_labels])
+    so softmax / argmax over outputs[0] give the ensemble prediction like a single model
+    """
+
+    def __init__(self, models, stack=True):
+        super(FoldEnsemble, self).__init__()
+        self.n_folds = len(models)
+        self.num_labels = models[0].config.num_labels
+        self.stacked = stack and torch_func() is not None and same_architecture(models)
+
+        if self.stacked:
+            # stack_module_state copies the weights, the fold modules are dropped afterwards
+            self.params, self.buffers_ = torch_func().stack_module_state(models)
+            self.base = copy.deepcopy(models[0]).to('meta')
+            self.vectorize = True
+        else:
+            self.models = nn.ModuleList(models)
+
+    @classmethod
+    def from_pretrained(cls, model_dirs, device, stack=True):
+        models = []
+        for model_dir in model_dirs:
+            model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+            model.to(device)
+            model.eval()
+            models.append(model)
+        return cls(models, stack=stack)
+
+    def _fold_logits(self, inputs):
+        if not self.stacked:
+            return torch.stack([model(**inputs)[0] for model in self.models])
+
+        func = torch_func()
+
+        def call(params, buffers):
+            return func.functional_call(self.base, (params, buffers), (), inputs)[0]
+
+        if self.vectorize:
+            try:
+                return func.vmap(call, randomness='same')(self.params, self.buffers_)
+            except RuntimeError:
+                # ops without a batching rule, fall back to slicing the stacked weights per fold
+                self.vectorize = False
+        return torch.stack([
+            call({name: p[k] for name, p in self.params.items()},
+                 {name: b[k] for name, b in self.buffers_.items()})
+            for k in range(self.n_folds)
+        ])
+
+    def forward(self, input_ids, attention_mask=None):
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        fold_probs = F.softmax(self._fold_logits(inputs), dim=-1)
+        probs = fold_probs.mean(dim=0)
+        return torch.log(probs), fold_probs
@@ -0,0 +1,341 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+from transformers import AutoModelForSequenceClassification
+from transformers.modeling_outputs import SequenceClassifierOutput
+
+MEMBERS_NAME = "members.json"
+HEAD_WEIGHTS_NAME = "pytorch_model.bin"
+SAFE_HEAD_WEIGHTS_NAME = "model.safetensors"
+ENSEMBLE_SPEC_NAME = "ensemble_spec.json"
+
+
+def checkpoint_signature(model_dir):
+    """
+    Identity of a saved checkpoint: its files with their sizes and modification times
+    """
+    return sorted(
+        (name, os.path.getsize(os.path.join(model_dir, name)), os.path.getmtime(os.path.join(model_dir, name)))
+        for name in os.listdir(model_dir)
+        if os.path.isfile(os.path.join(model_dir, name))
+    )
+
+
+def compute_member_logits(members, dataset, batch_size, collate_fn, device):
+    """
+    One forward pass of every frozen member over the dataset
+    returns the members' logits concatenated along the label axis, float32 [N, sum of num_labels]
+    """
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, collate_fn=collate_fn, shuffle=False)
+    logits = []
+    for member in members:
+        member.eval()
+    for data in tqdm(dataloader):
+        input_ids = data['input_ids'].to(device)
+        attention_mask = data['attention_mask'].to(device)
+        with torch.no_grad():
+            logits.append(torch.cat([
+                member(input_ids, attention_mask=attention_mask).get('logits').float()
+                for member in members
+            ], dim=-1).cpu())
+    return torch.cat(logits).numpy()
+
+
+class MemberLogitsCache:
+    """
+    On-disk store of frozen member logits, one .npy per (members, data) pair
+    a member retrained in place changes its checkpoint signature and so the key
+    """
+
+    def __init__(self, cache_dir="cache/member_logits"):
+        self.cache_dir = cache_dir
+
+    def key(self, member_dirs, data_fingerprint, **settings):
+        description = {
+            "version": 1,
+            "members": [(member_dir, checkpoint_signature(member_dir)) for member_dir in member_dirs],
+            "data": data_fingerprint,
+            "settings": settings,
+        }
+        return hashlib.sha1(
+            json.dumps(description, sort_keys=True).encode()
+        ).hexdigest()
+
+    def load(self, key):
+        entry = os.path.join(self.cache_dir, key + ".npy")
+        if not os.path.isfile(entry):
+            return None
+        return np.load(entry, mmap_mode="r")
+
+    def save(self, key, logits):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = os.path.join(self.cache_dir, key + ".npy")
+        tmp = os.path.join(self.cache_dir, f".{key}.{os.getpid()}.tmp.npy")
+        np.save(tmp, np.asarray(logits, dtype=np.float32))
+        os.replace(tmp, entry)
+        return self.load(key)
+
+
+class MemberLogitsDataset(Dataset):
+    """
+    Cached member logits (and labels) as a dataset for training the stacking head
+    indices: optional row view (e.g. one fold)
+    """
+
+    def __init__(self, logits, labels=None, indices=None):
+        self.logits = logits
+        self.labels = None if labels is None else np.asarray(labels)
+        self.indices = None if indices is None else np.asarray(indices)
+
+    def select(self, indices):
+        indices = np.asarray(indices)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return MemberLogitsDataset(self.logits, labels=self.labels, indices=indices)
+
+    def __getitem__(self, idx):
+        if self.indices is not None:
+            idx = self.indices[idx]
+        item = {"member_logits": torch.from_numpy(np.array(self.logits[idx], dtype=np.float32))}
+        if self.labels is not None:
+            item["labels"] = int(self.labels[idx])
+        return item
+
+    def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        return len(self.logits)
+
+
+class FrozenMembersMixin:
+    """
+    For nn.Modules made of frozen pretrained members (member_names) and a trainable head
+    state_dict only holds the head, the members are saved as references to their own checkpoints
+    (member_dirs, in members.json) so a checkpoint is megabytes and every backbone is read once.
+    load_state_dict also takes full checkpoints of older runs and skips their member weights
+    """
+
+    member_names = ()
+
+    def _is_member_key(self, key, prefix=""):
+        return any(key.startswith(f"{prefix}{name}.") for name in self.member_names)
+
+    def state_dict(self, *args, **kwargs):
+        state = super().state_dict(*args, **kwargs)
+        prefix = kwargs.get("prefix", args[1] if len(args) > 1 else "")
+        for key in [key for key in state if self._is_member_key(key, prefix)]:
+            del state[key]
+        return state
+
+    def load_state_dict(self, state_dict, strict=True, **kwargs):
+        head = {key: value for key, value in state_dict.items() if not self._is_member_key(key)}
+        result = super().load_state_dict(head, strict=False, **kwargs)
+        missing = [key for key in result.missing_keys if not self._is_member_key(key)]
+        if strict and (missing or result.unexpected_keys):
+            raise RuntimeError(
+                f"Error(s) in loading head of {type(self).__name__}: "
+                f"missing keys {missing}, unexpected keys {result.unexpected_keys}")
+        return result._replace(missing_keys=missing)
+
+    def save_members(self, save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+        with open(os.path.join(save_dir, MEMBERS_NAME), "w") as f:
+            json.dump(list(self.member_dirs), f, indent=4)
+
+    def save_head(self, save_dir):
+        self.save_members(save_dir)
+        torch.save(self.state_dict(), os.path.join(save_dir, HEAD_WEIGHTS_NAME))
+
+    def load_head(self, model_dir):
+        if os.path.isfile(os.path.join(model_dir, SAFE_HEAD_WEIGHTS_NAME)):
+            from safetensors.torch import load_file
+            state_dict = load_file(os.path.join(model_dir, SAFE_HEAD_WEIGHTS_NAME))
+        else:
+            state_dict = torch.load(os.path.join(model_dir, HEAD_WEIGHTS_NAME), map_location="cpu")
+        self.load_state_dict(state_dict)
+        return self
+
+
+def read_member_dirs(model_dir):
+    """
+    Member checkpoints a head was trained on, None for checkpoints saved without references
+    """
+    members = os.path.join(model_dir, MEMBERS_NAME)
+    if not os.path.isfile(members):
+        return None
+    with open(members) as f:
+        return json.load(f)
+
+
+def load_ensemble_spec(file, k=None):
+    """
+    k: fold filled into member paths written with a {k} placeholder (split_model_rel_large/{k}_fold)
+    """
+    with open(file) as f:
+        spec = json.load(f)
+    if k is not None:
+        for member in spec['members'].values():
+            member['path'] = member['path'].format(k=k)
+    return spec
+
+
+class StackedEnsemble(FrozenMembersMixin, nn.Module):
+    """
+    Frozen members and a trainable head built from a declarative spec (see config/ensemble):
+        members: name -> {"path": checkpoint, "num_labels": n}
+        head:    {"projections": {name: in_features}, "hidden_size", "num_labels", "dropout"}
+        fusion:  {"type": "concat" | "mean", "inputs": [[member, projection], ...]}
+    each fusion input projects a member's logits to hidden_size, the projected vectors are fused
+    and classified. members are loaded on first use, in parallel, and only if a fusion input reads them.
+    the head keeps the fcN / classifier names of SplitModels, so its checkpoints load here and back
+    """
+
+    def __init__(self, spec):
+        super(StackedEnsemble, self).__init__()
+        self.spec = spec
+        self.inputs = [tuple(pair) for pair in spec['fusion']['inputs']]
+        self.fusion = spec['fusion'].get('type', 'concat')
+        if self.fusion not in ('concat', 'mean'):
+            raise ValueError(f"unknown fusion type {self.fusion}")
+
+        used = []
+        for member, _ in self.inputs:
+            if member not in used:
+                used.append(member)
+        skipped = [name for name in spec['members'] if name not in used]
+        if skipped:
+            print(f'members without a fusion input are not loaded: {skipped}')
+        self.member_names = tuple(spec['members'])
+        self.used_members = used
+        self.member_dirs = [spec['members'][name]['path'] for name in used]
+        self.loaded = False
+        self.workers = 1
+        self._executor = None
+        self._threads = None
+
+        head = spec['head']
+        hidden_size = head.get('hidden_size', 768)
+        dropout = head.get('dropout', 0.1)
+        for name, in_features in head['projections'].items():
+            self.add_module(name, nn.Linear(in_features, hidden_size))
+        fused_size = hidden_size * (len(self.inputs) if self.fusion == 'concat' else 1)
+        self.classifier = nn.Sequential(
+            nn.Dropout(p=dropout),
+            nn.Linear(fused_size, hidden_size, bias=True),
+            nn.Tanh(),
+            nn.Dropout(p=dropout),
+            nn.Linear(hidden_size, head.get('num_labels', 30), bias=True)
+        )
+
+    @classmethod
+    def from_spec(cls, file, k=None):
+        return cls(load_ensemble_spec(file, k=k))
+
+    def load_members(self, max_workers=None):
+        """
+        Load the used members in parallel threads with low cpu memory initialization,
+        frozen and on the device of the head
+        """
+        if self.loaded:
+            return
+        device = self.classifier[1].weight.device
+
+        def load(name):
+            member = self.spec['members'][name]
+            model = AutoModelForSequenceClassification.from_pretrained(
+                member['path'], num_labels=member['num_labels'], low_cpu_mem_usage=True)
+            for p in model.parameters():
+                p.requires_grad = False
+            return model.eval().to(device)
+
+        with ThreadPoolExecutor(max_workers=max_workers or len(self.used_members)) as executor:
+            for name, model in zip(self.used_members, executor.map(load, self.used_members)):
+                self.add_module(name, model)
+        self.loaded = True
+
+    def members(self):
+        self.load_members()
+        return [getattr(self, name) for name in self.used_members]
+
+    def parallel(self, workers, intra_op_threads=None):
+        """
+        Run the members on `workers` threads at once, each with its own team of intra_op_threads
+        (default: the current intra-op threads split evenly), workers <= 1 runs them one after another.
+        torch keeps one intra-op setting per process, it is lowered to the per worker share while
+        the members run in parallel and restored when going back to sequential. meant for cpu hosts,
+        members on one gpu share its stream anyway
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._threads is not None:
+            torch.set_num_threads(self._threads)
+            self._threads = None
+
+        self.workers = max(1, min(workers, len(self.used_members)))
+        if self.workers == 1:
+            return self
+        self._threads = torch.get_num_threads()
+        intra_op_threads = intra_op_threads or max(1, self._threads // self.workers)
+        torch.set_num_threads(intra_op_threads)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, initializer=torch.set_num_threads, initargs=(intra_op_threads,))
+        return self
+
+    def member_logits(self, input_ids, attention_mask):
+        """
+        Logits of the used members concatenated in their order, the layout compute_member_logits stores
+        """
+        members = self.members()
+        if self._executor is None:
+            return torch.cat([
+                member(input_ids, attention_mask=attention_mask).get('logits')
+                for member in members
+            ], dim=-1)
+
+        # grad mode is thread local, the workers follow the caller
+        grad_enabled = torch.is_grad_enabled()
+
+        def run(member):
+            with torch.set_grad_enabled(grad_enabled):
+                return member(input_ids, attention_mask=attention_mask).get('logits')
+
+        return torch.cat(list(self._executor.map(run, members)), dim=-1)
+
+    def forward(self, input_ids=None, attention_mask=None, member_logits=None):
+        if member_logits is None:
+            member_logits = self.member_logits(input_ids, attention_mask)
+        sizes = [self.spec['members'][name]['num_labels'] for name in self.used_members]
+        logits = dict(zip(self.used_members, torch.split(
+            member_logits.to(self.classifier[1].weight.dtype), sizes, dim=-1)))
+
+        vectors = [getattr(self, projection)(logits[member]) for member, projection in self.inputs]
+        if self.fusion == 'concat':
+            fused = torch.cat(vectors, dim=-1)
+        else:
+            fused = torch.stack(vectors).mean(dim=0)
+        return SequenceClassifierOutput(logits=self.classifier(fused))
+
+    def save_members(self, save_dir):
+        super().save_members(save_dir)
+        with open(os.path.join(save_dir, ENSEMBLE_SPEC_NAME), "w") as f:
+            json.dump(self.spec, f, indent=4)
+
+
+def read_ensemble_spec(model_dir):
+    """
+    Spec a StackedEnsemble head was saved with, None for other checkpoints
+    """
+    spec = os.path.join(model_dir, ENSEMBLE_SPEC_NAME)
+    if not os.path.isfile(spec):
+        return None
+    return load_ensemble_spec(spec)
@@ -0,0 +1,231 @@
+import argparse
+import asyncio
+import copy
+import ipaddress
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from aiohttp import web
+
+from transformers import AutoTokenizer, DataCollatorWithPadding
+
+from utils import ENTITY_TYPES, load_label_codec, preprocess_frame, tokenize_frame
+from model.backends import COMPILE_BUCKETS, load_model
+from serving import DeadlineExceeded, MicroBatcher, Overloaded
+
+ENTITY_KEYS = ("word", "start_idx", "end_idx", "type")
+
+
+def entity_string(entity):
+    """
+    entities are sent as JSON objects or as the dict strings of the KLUE RE csv, both become the csv form
+    """
+    if isinstance(entity, dict):
+        missing = [key for key in ENTITY_KEYS if key not in entity]
+        if missing:
+            raise ValueError(f'entity {entity} is missing {missing}')
+        if entity['type'] not in ENTITY_TYPES:
+            raise ValueError(f'entity type {entity["type"]!r} is not one of {list(ENTITY_TYPES)}')
+        return str({key: entity[key] for key in ENTITY_KEYS})
+    if isinstance(entity, str):
+        return entity
+    raise ValueError(f'entity must be an object or a string, got {entity!r}')
+
+
+class RelationExtractionService:
+    """
+    Preprocessing, tokenization and prediction of raw {sentence, subject_entity, object_entity} requests,
+    the same entity marking (utils.mark_entities, the columnar add_entity_tokens) as training and inference.py
+    """
+
+    def __init__(self, model, tokenizer, label_codec, device, add_ent_token=True):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.collator = DataCollatorWithPadding(tokenizer=tokenizer)
+        self.labels = [str(label) for label in label_codec.labels]
+        self.device = device
+        self.add_ent_token = add_ent_token
+        self._local = threading.local()
+
+    def thread_tokenizer(self):
+        """
+        the preprocessing thread's own copy of the tokenizer, a fast tokenizer encoding on several
+        threads at once fails with "Already borrowed"
+        """
+        tokenizer = getattr(self._local, 'tokenizer', None)
+        if tokenizer is None:
+            tokenizer = self._local.tokenizer = copy.deepcopy(self.tokenizer)
+        return tokenizer
+
+    def preprocess(self, requests):
+        """
+        tokenized features of each request
+        """
+        try:
+            data = pd.DataFrame({
+                'sentence': [request['sentence'] for request in requests],
+                'subject_entity': [entity_string(request['subject_entity']) for request in requests],
+                'object_entity': [entity_string(request['object_entity']) for request in requests],
+            })
+        except KeyError as e:
+            raise ValueError(f'request is missing {e}')
+        try:
+            sentences, subjects, objects = preprocess_frame(data, self.add_ent_token)
+        except KeyError as e:
+            # entities sent as csv strings are only checked while parsing
+            raise ValueError(f'unknown entity type or missing entity key {e}, types are {list(ENTITY_TYPES)}')
+        encoding = tokenize_frame(
+            pd.DataFrame({'sentence': sentences, 'subject_entity': subjects, 'object_entity': objects}),
+            self.thread_tokenizer(), self.add_ent_token)
+        return [
+            {'input_ids': input_ids, 'attention_mask': attention_mask}
+            for input_ids, attention_mask in zip(encoding['input_ids'], encoding['attention_mask'])
+        ]
+
+    def predict(self, features):
+        """
+        label and probabilities of every feature of one micro-batch
+        """
+        batch = self.collator(features)
+        with torch.no_grad():
+            logits = self.model(
+                input_ids=batch['input_ids'].to(self.device),
+                attention_mask=batch['attention_mask'].to(self.device)
+            )[0]
+        probs = F.softmax(logits.float(), dim=-1).cpu()
+        return [
+            {'label': self.labels[int(prob.argmax())], 'probs': dict(zip(self.labels, prob.tolist()))}
+            for prob in probs
+        ]
+
+
+def make_app(service, batcher, preprocess_workers=1):
+    # parsing and tokenizing run off the event loop, on threads of their own so they never wait for the model
+    preprocessor = ThreadPoolExecutor(max_workers=preprocess_workers)
+
+    async def predict(request):
+        # shed before parsing and tokenizing, an overloaded server spends nothing on rejected calls
+        reason = batcher.overloaded()
+        if reason is not None:
+            batcher.rejected += 1
+            raise web.HTTPServiceUnavailable(text=reason, headers={'Retry-After': '1'})
+        try:
+            deadline = float(request.headers.get('X-Deadline-Ms', 0)) / 1000 or None
+        except ValueError:
+            raise web.HTTPBadRequest(text='X-Deadline-Ms must be a number')
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text='body must be JSON')
+        requests = body if isinstance(body, list) else [body]
+        try:
+            features = await asyncio.get_running_loop().run_in_executor(
+                preprocessor, service.preprocess, requests)
+        except (ValueError, SyntaxError, TypeError) as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        # rows of one call are queued together and may share a micro-batch with other callers,
+        # one shed or expired row fails the call and withdraws the others
+        tasks = [
+            asyncio.ensure_future(batcher.submit(feature, len(feature['input_ids']), deadline=deadline))
+            for feature in features
+        ]
+        try:
+            outputs = await asyncio.gather(*tasks)
+        except Overloaded as e:
+            raise web.HTTPServiceUnavailable(text=str(e), headers={'Retry-After': '1'})
+        except DeadlineExceeded as e:
+            raise web.HTTPGatewayTimeout(text=str(e))
+        finally:
+            for task in tasks:
+                task.cancel()
+        return web.json_response(outputs if isinstance(body, list) else outputs[0])
+
+    async def stats(request):
+        return web.json_response(batcher.stats())
+
+    async def health(request):
+        return web.json_response({'status': 'ok'})
+
+    async def on_startup(app):
+        batcher.start()
+
+    async def on_cleanup(app):
+        await batcher.stop()
+        preprocessor.shutdown()
+
+    app = web.Application()
+    app.add_routes([
+        web.post('/predict', predict),
+        web.get('/stats', stats),
+        web.get('/health', health),
+    ])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def check_localhost(host):
+    """
+    the service is only for callers on this machine, refuse to bind anything but a loopback address
+    """
+    address = ipaddress.ip_address(socket.gethostbyname(host))
+    if not address.is_loopback:
+        raise ValueError(f'{host} ({address}) is not a loopback address, the service only listens on localhost')
+
+
+def serve(args):
+    check_localhost(args.host)
+    device = torch.device(
+        'cuda' if torch.cuda.is_available() and args.backend in ('fp32', 'torchscript') else 'cpu')
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    model = load_model(args.model_dir, args.backend, device, args.buckets)
+    service = RelationExtractionService(
+        model, tokenizer, load_label_codec(args.dictionary), device, add_ent_token=args.add_ent_token)
+    batcher = MicroBatcher(
+        service.predict, max_wait=args.max_wait_ms / 1000,
+        max_tokens=args.max_tokens, max_batch_size=args.max_batch_size,
+        max_queue=args.max_queue, max_inflight_tokens=args.max_inflight_tokens,
+        deadline=args.deadline_ms / 1000 or None)
+
+    web.run_app(make_app(service, batcher, args.preprocess_workers), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='localhost HTTP relation extraction service, POST /predict, GET /stats for p50/p99 latency '
+                    'and admission counters')
+
+    parser.add_argument('--model_dir', type=str, default=path.join('best_model', 'plain'))
+    parser.add_argument('--model_name', type=str, default='klue/bert-base')
+    parser.add_argument('--dictionary', type=str,
+                        default='data/dict_num_to_label.pkl')
+    parser.add_argument('--backend', type=str, default='fp32', choices=['fp32', 'quantized', 'onnx', 'torchscript'])
+    parser.add_argument('--buckets', type=int, nargs='+', default=list(COMPILE_BUCKETS))
+    parser.add_argument('--add_ent_token', type=bool, default=True)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_wait_ms', type=float, default=5,
+                        help='longest a request waits for others to share its batch')
+    parser.add_argument('--max_tokens', type=int, default=8192,
+                        help='padded tokens (longest * rows) of one micro-batch')
+    parser.add_argument('--max_batch_size', type=int, default=64)
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help='threads parsing and tokenizing requests next to the model thread')
+    parser.add_argument('--max_queue', type=int, default=1024,
+                        help='requests waiting for the model, more are rejected with 503 (0: unbounded)')
+    parser.add_argument('--max_inflight_tokens', type=int, default=262144,
+                        help='tokens of admitted unanswered requests, more are rejected with 503 (0: unbounded)')
+    parser.add_argument('--deadline_ms', type=float, default=2000,
+                        help='default request deadline, answered 504 past it, X-Deadline-Ms overrides it (0: none)')
+
+    args = parser.parse_args()
+    print(args)
+
+    serve(args=args)
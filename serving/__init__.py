@@ -0,0 +1 @@
+from .batcher import *
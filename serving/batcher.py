@@ -0,0 +1,241 @@
+import asyncio
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class LatencyTracker:
+    """
+    Latencies (seconds) of the most recent requests, summarized as percentiles in milliseconds
+    """
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self.count += 1
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        return float(np.percentile(np.fromiter(self.latencies, dtype=np.float64), q)) * 1000
+
+    def summary(self):
+        return {
+            "requests": self.count,
+            "p50_ms": self.percentile(50),
+            "p99_ms": self.percentile(99),
+        }
+
+
+class Overloaded(Exception):
+    """
+    Request shed at admission, the queue or the in-flight token budget is full
+    """
+
+
+class DeadlineExceeded(Exception):
+    """
+    Request not answered before its deadline
+    """
+
+
+Pending = namedtuple("Pending", ["features", "n_tokens", "future", "arrival", "deadline"])
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches for one model
+    a batch is closed once its oldest request waited max_wait seconds, or when the next request would
+    push its padded size (longest * rows) past max_tokens or its rows past max_batch_size.
+    predict(list of features) -> list of outputs runs on a single worker thread so the event loop keeps
+    accepting requests, and the next batch fills up while the current one is on the model
+
+    admission control, so overload turns into fast rejections instead of an ever growing queue:
+    max_queue requests may wait for the model and max_inflight_tokens tokens may be admitted and
+    unanswered at once, anything past either is rejected with Overloaded right away (0 disables a limit).
+    a request past its deadline (default `deadline` seconds) gets DeadlineExceeded, and if it is
+    still queued it is dropped without reaching the model
+    """
+
+    def __init__(self, predict, max_wait=0.005, max_tokens=8192, max_batch_size=64,
+                 max_queue=1024, max_inflight_tokens=262144, deadline=None):
+        self.predict = predict
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_queue = max_queue
+        self.max_inflight_tokens = max_inflight_tokens
+        self.deadline = deadline
+        self.latency = LatencyTracker()
+        self.batches = 0
+        self.batched_requests = 0
+        self.waiting = 0
+        self.inflight_tokens = 0
+        self.rejected = 0
+        self.expired = 0
+        self.batch_seconds = 0.0
+        self._queue = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown()
+
+    def overloaded(self, n_tokens=0):
+        """
+        Why a request of n_tokens would be rejected now, None if it would be admitted
+        """
+        if self.max_queue and self.waiting >= self.max_queue:
+            return f"queue full ({self.waiting} waiting)"
+        # an idle batcher admits anything, a single long request is never shed forever
+        if self.max_inflight_tokens and self.inflight_tokens \
+                and self.inflight_tokens + n_tokens > self.max_inflight_tokens:
+            return f"token budget full ({self.inflight_tokens} tokens in flight)"
+        return None
+
+    async def submit(self, features, n_tokens, deadline=None):
+        """
+        Queue one request and wait for its output
+        deadline: seconds the caller waits at most, defaults to the batcher's deadline
+        """
+        reason = self.overloaded(n_tokens)
+        if reason is not None:
+            self.rejected += 1
+            raise Overloaded(reason)
+
+        loop = asyncio.get_running_loop()
+        arrival = loop.time()
+        deadline = deadline or self.deadline
+        pending = Pending(features, n_tokens, loop.create_future(), arrival,
+                          arrival + deadline if deadline else float("inf"))
+        self.waiting += 1
+        self.inflight_tokens += n_tokens
+        self._queue.put_nowait(pending)
+        try:
+            try:
+                # shielded, a timeout here leaves the batcher to drop or finish the request and free its tokens
+                output = await asyncio.wait_for(asyncio.shield(pending.future), deadline)
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"no answer within {deadline * 1000:.0f} ms")
+        except DeadlineExceeded:
+            pending.future.cancel()
+            self.expired += 1
+            raise
+        except asyncio.CancelledError:
+            pending.future.cancel()
+            raise
+        self.latency.record(loop.time() - arrival)
+        return output
+
+    def _release(self, pending):
+        self.inflight_tokens -= pending.n_tokens
+
+    def fits(self, batch, longest, pending):
+        return (
+            len(batch) < self.max_batch_size
+            and max(longest, pending.n_tokens) * (len(batch) + 1) <= self.max_tokens
+        )
+
+    def _drop(self, pending):
+        """
+        Release a request withdrawn by its caller, or one that would expire before a batch started now
+        finishes (by the running mean batch time), True if it was dropped. the model only gets work
+        that can still be answered in time
+        """
+        finish = asyncio.get_running_loop().time() + self.batch_seconds
+        if not pending.future.done() and finish <= pending.deadline:
+            return False
+        if not pending.future.done():
+            pending.future.set_exception(DeadlineExceeded("expired in the queue"))
+        self._release(pending)
+        return True
+
+    async def _get(self):
+        # dropped requests never take a batch slot, batches stay full under overload
+        while True:
+            pending = await self._queue.get()
+            self.waiting -= 1
+            if not self._drop(pending):
+                return pending
+
+    def _get_nowait(self):
+        while not self._queue.empty():
+            pending = self._queue.get_nowait()
+            self.waiting -= 1
+            if not self._drop(pending):
+                return pending
+        return None
+
+    async def _next_batch(self, carried):
+        loop = asyncio.get_running_loop()
+        if carried is not None and self._drop(carried):
+            carried = None
+        first = carried or await self._get()
+        batch, longest = [first], first.n_tokens
+        while True:
+            timeout = first.arrival + self.max_wait - loop.time()
+            if timeout > 0:
+                try:
+                    pending = await asyncio.wait_for(self._get(), timeout)
+                except asyncio.TimeoutError:
+                    return batch, None
+            else:
+                # past the wait, requests already queued still join for free
+                pending = self._get_nowait()
+                if pending is None:
+                    return batch, None
+            if not self.fits(batch, longest, pending):
+                return batch, pending
+            batch.append(pending)
+            longest = max(longest, pending.n_tokens)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        carried = None
+        while True:
+            batch, carried = await self._next_batch(carried)
+            batch = [pending for pending in batch if not self._drop(pending)]
+            if not batch:
+                continue
+            self.batches += 1
+            self.batched_requests += len(batch)
+            start = loop.time()
+            try:
+                outputs = await loop.run_in_executor(
+                    self._executor, self.predict, [pending.features for pending in batch])
+                self.batch_seconds += 0.2 * (loop.time() - start - self.batch_seconds)
+            except Exception as e:
+                for pending in batch:
+                    self._release(pending)
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                continue
+            for pending, output in zip(batch, outputs):
+                self._release(pending)
+                if not pending.future.done():
+                    pending.future.set_result(output)
+
+    def stats(self):
+        stats = self.latency.summary()
+        stats["batches"] = self.batches
+        stats["mean_batch_size"] = self.batched_requests / self.batches if self.batches else None
+        stats["rejected"] = self.rejected
+        stats["expired"] = self.expired
+        stats["waiting"] = self.waiting
+        stats["inflight_tokens"] = self.inflight_tokens
+        stats["batch_ms"] = self.batch_seconds * 1000
+        return stats
+
@@ -0,0 +1,204 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import torch
+from torch import nn
+from aiohttp.test_utils import TestClient, TestServer
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from serve import RelationExtractionService, make_app
+from serving import DeadlineExceeded, MicroBatcher, Overloaded
+from utils import LabelCodec
+
+
+class GatedModel:
+    """
+    predict stand-in that holds every batch until the gate opens, records what reached it
+    """
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.seen = []
+
+    def predict(self, features):
+        self.gate.wait()
+        self.seen.extend(features)
+        return features
+
+
+async def until(condition, timeout=5):
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    while not condition():
+        if loop.time() > end:
+            raise AssertionError('condition not reached')
+        await asyncio.sleep(0.001)
+
+
+class MicroBatcherTest(unittest.TestCase):
+
+    def run_batcher(self, scenario, **kwargs):
+        async def run():
+            model = GatedModel()
+            batcher = MicroBatcher(model.predict, max_wait=0, max_batch_size=1, **kwargs)
+            batcher.start()
+            try:
+                await scenario(batcher, model)
+            finally:
+                model.gate.set()
+                await batcher.stop()
+            self.assertEqual(batcher.inflight_tokens, 0)
+            return batcher, model
+
+        return asyncio.run(run())
+
+    def test_answers(self):
+        async def scenario(batcher, model):
+            model.gate.set()
+            outputs = await asyncio.gather(*[batcher.submit(i, n_tokens=4) for i in range(3)])
+            self.assertEqual(outputs, [0, 1, 2])
+
+        batcher, _ = self.run_batcher(scenario)
+        self.assertEqual(batcher.batches, 3)
+
+    def test_sheds_past_max_queue(self):
+        async def scenario(batcher, model):
+            running = asyncio.ensure_future(batcher.submit('running', n_tokens=4))
+            await until(lambda: batcher.waiting == 0 and batcher.inflight_tokens == 4)
+            queued = asyncio.ensure_future(batcher.submit('queued', n_tokens=4))
+            await until(lambda: batcher.waiting == 1)
+
+            with self.assertRaises(Overloaded):
+                await batcher.submit('shed', n_tokens=4)
+            self.assertEqual(batcher.inflight_tokens, 8)
+
+            model.gate.set()
+            self.assertEqual(await asyncio.gather(running, queued), ['running', 'queued'])
+
+        batcher, model = self.run_batcher(scenario, max_queue=1)
+        self.assertEqual(batcher.rejected, 1)
+        self.assertNotIn('shed', model.seen)
+
+    def test_sheds_past_token_budget(self):
+        async def scenario(batcher, model):
+            running = asyncio.ensure_future(batcher.submit('running', n_tokens=6))
+            await until(lambda: batcher.inflight_tokens == 6)
+            with self.assertRaises(Overloaded):
+                await batcher.submit('shed', n_tokens=6)
+            model.gate.set()
+            await running
+
+        batcher, _ = self.run_batcher(scenario, max_inflight_tokens=10)
+        self.assertEqual(batcher.rejected, 1)
+
+    def test_expired_request_never_reaches_the_model(self):
+        async def scenario(batcher, model):
+            running = asyncio.ensure_future(batcher.submit('running', n_tokens=4, deadline=5))
+            await until(lambda: batcher.waiting == 0 and batcher.inflight_tokens == 4)
+
+            with self.assertRaises(DeadlineExceeded):
+                await batcher.submit('expired', n_tokens=4, deadline=0.05)
+
+            model.gate.set()
+            await running
+            await until(lambda: batcher.inflight_tokens == 0)
+
+        batcher, model = self.run_batcher(scenario)
+        self.assertEqual(batcher.expired, 1)
+        self.assertEqual(model.seen, ['running'])
+
+    def test_withdrawn_request_never_reaches_the_model(self):
+        async def scenario(batcher, model):
+            running = asyncio.ensure_future(batcher.submit('running', n_tokens=4))
+            await until(lambda: batcher.waiting == 0 and batcher.inflight_tokens == 4)
+            withdrawn = asyncio.ensure_future(batcher.submit('withdrawn', n_tokens=4))
+            await until(lambda: batcher.waiting == 1)
+
+            withdrawn.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await withdrawn
+
+            model.gate.set()
+            await running
+            await until(lambda: batcher.inflight_tokens == 0)
+
+        _, model = self.run_batcher(scenario)
+        self.assertEqual(model.seen, ['running'])
+
+
+class ConstantModel(nn.Module):
+    """
+    classifier stand-in with the same logits for every row
+    """
+
+    def __init__(self, num_labels):
+        super(ConstantModel, self).__init__()
+        self.num_labels = num_labels
+
+    def forward(self, input_ids, attention_mask=None):
+        return (torch.zeros(len(input_ids), self.num_labels),)
+
+
+class BorrowCheckedTokenizer(PreTrainedTokenizerFast):
+    """
+    Fails like a Rust backed tokenizer ("Already borrowed") whenever one instance encodes on two threads
+    at once, every call holds the instance for a while so overlapping calls are caught
+    """
+
+    def __call__(self, *args, **kwargs):
+        if getattr(self, 'busy', False):
+            raise RuntimeError('Already borrowed')
+        self.busy = True
+        try:
+            time.sleep(0.005)
+            return super().__call__(*args, **kwargs)
+        finally:
+            self.busy = False
+
+
+def character_tokenizer(sentences):
+    """
+    fast tokenizer with one token per character of the sentences, no download needed
+    """
+    vocab = {'[PAD]': 0, '[UNK]': 1}
+    for char in sorted(set(''.join(sentences))):
+        vocab.setdefault(char, len(vocab))
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token='[UNK]'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split('', 'isolated')
+    return BorrowCheckedTokenizer(
+        tokenizer_object=tokenizer, pad_token='[PAD]', unk_token='[UNK]', model_max_length=512)
+
+
+class ServiceTest(unittest.TestCase):
+
+    def test_concurrent_requests(self):
+        sentence = '이순신은 조선 중기의 무신이다. ' * 20
+        body = {
+            'sentence': sentence,
+            'subject_entity': {'word': '이순신', 'start_idx': 0, 'end_idx': 2, 'type': 'PER'},
+            'object_entity': {'word': '무신', 'start_idx': 13, 'end_idx': 14, 'type': 'POH'},
+        }
+        labels = LabelCodec(['no_relation', 'per:title'])
+        tokenizer = character_tokenizer([sentence, '@^인물^#*기타*'])
+        service = RelationExtractionService(
+            ConstantModel(len(labels)), tokenizer, labels, torch.device('cpu'))
+
+        async def run():
+            batcher = MicroBatcher(service.predict, max_wait=0.001)
+            # several preprocessing threads tokenizing at once
+            async with TestClient(TestServer(make_app(service, batcher, preprocess_workers=4))) as client:
+                async def post():
+                    response = await client.post('/predict', json=[body] * 4)
+                    return response.status, await response.text()
+
+                return await asyncio.gather(*[post() for _ in range(32)])
+
+        for status, text in asyncio.run(run()):
+            self.assertEqual(status, 200, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,7 +10,9 @@ from datasets.load import load_metric
 from tqdm import tqdm
 import wandb
 
-from trainer import MyTrainer, init_training_arguments
+from transformers.trainer_utils import get_last_checkpoint
+
+from trainer import MyTrainer, init_training_arguments, FoldManifest, hash_config, move_aside
 from utils import RelationExtractionDataset, DataHelper, FixedDataHelper, ConfigParser
 from model.metric import compute_metrics
 import os
@@ -35,6 +37,30 @@ def evaluate(model, val_dataset, batch_size, collate_fn, device, eval_method='f1
     return metric.compute(average='micro')[eval_method]
 
 
+# training arguments that change the trained model (through checkpoint selection or precision),
+# the others only set paths, logging and speed
+MODEL_TRAINING_ARGUMENTS = ('evaluation_strategy', 'save_strategy', 'eval_steps', 'save_steps',
+                            'load_best_model_at_end', 'metric_for_best_model', 'fp16', 'fp16_opt_level')
+
+
+def model_settings(config, mode, evaluation_strategy):
+    """
+    The part of a config that decides what a fold trains to: model, data, seed, fold split,
+    optimization and checkpoint selection. num_workers, group_by_length, logging, output paths
+    and wandb are left out, so changing them keeps finished and interrupted folds
+    """
+    training_arguments_config = config['training_arguments']
+    return {
+        'model_dir': config['model_dir'],
+        'seed': config['seed'],
+        'mode': mode,
+        'evaluation_strategy': evaluation_strategy,
+        'data': {key: value for key, value in config['data'].items() if key != 'num_workers'},
+        'hyperparameter': training_arguments_config['hyperparameter'],
+        'training_arguments': {key: training_arguments_config.get(key) for key in MODEL_TRAINING_ARGUMENTS},
+    }
+
+
 def train_loop_using_fixed_dataset(config, mode='plain', evaluation_strategy='epoch', disable_wandb=True):
     # Config parse and init configures
     data_config = config['data']
@@ -57,7 +83,8 @@ def train_loop_using_fixed_dataset(config, mode='plain', evaluation_strategy='ep
     helper = FixedDataHelper(train_data_dir=data_config['train_data_dir'],
                              valid_data_dir=data_config['valid_data_dir'],
                              add_ent_token=data_config['add_ent_token'],
-                             add_data_dir=data_config['add_data_dir'])
+                             add_data_dir=data_config['add_data_dir'],
+                             num_workers=data_config.get('num_workers', 1))
 
     # TODO: kfold fixed dataset
     train_data, train_labels = helper.train_data, helper.train_labels
@@ -134,19 +161,28 @@ def train_loop(config, mode='plain', evaluation_strategy='epoch', disable_wandb=
     val_scores = []
     helper = DataHelper(data_dir=data_config['data_dir'],
                         add_ent_token=data_config['add_ent_token'],
-                        add_data_dir=data_config['add_data_dir'])
+                        add_data_dir=data_config['add_data_dir'],
+                        num_workers=data_config.get('num_workers', 1))
 
-    for k, (train_idxs, val_idxs) in enumerate(helper.split(ratio=data_config['split_ratio'], n_splits=data_config['n_splits'], mode=mode, random_seed=config['seed'])):
-        train_data, train_labels = helper.from_idxs(idxs=train_idxs)
-        val_data, val_labels = helper.from_idxs(idxs=val_idxs)
+    dataset = helper.to_dataset(tokenizer=tokenizer)
 
-        train_data = helper.tokenize(train_data, tokenizer=tokenizer)
-        val_data = helper.tokenize(val_data, tokenizer=tokenizer)
+    # folds finished by an earlier (crashed) run with the same model settings and data are skipped
+    manifest = FoldManifest(
+        training_arguments_config['save_dir'],
+        config_hash=hash_config(model_settings(config, mode, evaluation_strategy)),
+        data_hash=helper.fingerprint()
+    )
+
+    for k, (train_idxs, val_idxs) in enumerate(helper.split(ratio=data_config['split_ratio'], n_splits=data_config['n_splits'], mode=mode, random_seed=config['seed'])):
+        fold = f'{k}_fold' if mode == 'skf' else mode
+        completed = manifest.completed(fold)
+        if completed is not None:
+            print(f'{fold} already trained, score {completed["score"]}')
+            val_scores.append(completed['score'])
+            continue
 
-        train_dataset = RelationExtractionDataset(
-            train_data, labels=train_labels)
-        val_dataset = RelationExtractionDataset(
-            val_data, labels=val_labels)
+        train_dataset = dataset.select(train_idxs)
+        val_dataset = dataset.select(val_idxs)
 
         model = AutoModelForSequenceClassification.from_pretrained(
             model_dir, config=model_config)
@@ -160,8 +196,20 @@ def train_loop(config, mode='plain', evaluation_strategy='epoch', disable_wandb=
                 group=wandb_config['group']
             )
 
+        # per fold checkpoints so a preempted fold resumes from its own latest checkpoint,
+        # checkpoints of a fold not started under these settings and data (or before the manifest)
+        # are never resumed, they are moved aside and the fold trains from scratch
+        fold_output_dir = path.join(training_arguments_config['output_dir'], fold)
+        last_checkpoint = None
+        if manifest.started(fold):
+            if path.isdir(fold_output_dir):
+                last_checkpoint = get_last_checkpoint(fold_output_dir)
+        elif path.isdir(fold_output_dir):
+            print(f'{fold_output_dir} was not started with these settings and data, '
+                  f'moved to {move_aside(fold_output_dir)}')
+        manifest.start(fold)
         training_args = init_training_arguments(
-            evaluation_strategy, training_arguments_config, hyperparameter_config)
+            evaluation_strategy, {**training_arguments_config, 'output_dir': fold_output_dir}, hyperparameter_config)
 
         trainer = MyTrainer(
             disable_wandb=disable_wandb,
@@ -172,9 +220,9 @@ def train_loop(config, mode='plain', evaluation_strategy='epoch', disable_wandb=
             compute_metrics=compute_metrics,
             data_collator=data_collator
         )
-        trainer.train()
-        model.save_pretrained(
-            path.join(training_arguments_config['save_dir'], f'{k}_fold' if mode == 'skf' else mode))
+        trainer.train(resume_from_checkpoint=last_checkpoint)
+        fold_save_dir = path.join(training_arguments_config['save_dir'], fold)
+        model.save_pretrained(fold_save_dir)
 
         score = evaluate(
             model=model,
@@ -184,6 +232,7 @@ def train_loop(config, mode='plain', evaluation_strategy='epoch', disable_wandb=
             device=device
         )
         val_scores.append(score)
+        manifest.record(fold, checkpoint=fold_save_dir, score=score)
 
         if disable_wandb == False:
             wandb.log({'fold': score})
@@ -0,0 +1,76 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from model.stacking import StackedEnsemble
+
+
+def measure(model, batches, warmup=1):
+    """
+    per batch latencies in seconds and the logits of every batch
+    """
+    latencies, outputs = [], []
+    with torch.no_grad():
+        for input_ids, attention_mask in batches[:warmup]:
+            model(input_ids=input_ids, attention_mask=attention_mask)
+        for input_ids, attention_mask in batches:
+            start = time.perf_counter()
+            outputs.append(model(input_ids=input_ids, attention_mask=attention_mask).logits)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies), torch.cat(outputs)
+
+
+def benchmark(args):
+    torch.manual_seed(args.seed)
+    model = StackedEnsemble.from_spec(args.ensemble_spec, k=args.member_fold)
+    model.eval()
+    model.load_members()
+    vocab_size = model.members()[0].config.vocab_size
+
+    batches = [
+        (torch.randint(5, vocab_size, (args.batch_size, args.seq_len)),
+         torch.ones(args.batch_size, args.seq_len, dtype=torch.long))
+        for _ in range(args.n_batches)
+    ]
+    print(f'{len(model.used_members)} members, {torch.get_num_threads()} intra-op threads, '
+          f'{args.n_batches} batches of {args.batch_size} x {args.seq_len} tokens')
+
+    reference = None
+    for workers in args.workers:
+        model.parallel(workers, intra_op_threads=args.intra_op_threads)
+        latencies, logits = measure(model, batches, warmup=args.warmup)
+        if reference is None:
+            reference = logits
+        max_diff = (logits - reference).abs().max().item()
+        print(f'workers {model.workers:>2}: '
+              f'p50 {np.percentile(latencies, 50) * 1000:8.1f} ms  '
+              f'p99 {np.percentile(latencies, 99) * 1000:8.1f} ms  '
+              f'{args.batch_size * len(latencies) / latencies.sum():8.1f} sentences/s  '
+              f'max |diff| {max_diff:.2e}')
+    model.parallel(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='latency and throughput of a spec built combine model with its members run '
+                    'one after another (workers 1) and on parallel threads')
+
+    parser.add_argument('--ensemble_spec', type=str,
+                        default='config/ensemble/combine_models.json')
+    parser.add_argument('--member_fold', type=int, default=4,
+                        help='fold filled into {k} member paths of the spec')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--intra_op_threads', type=int, default=None,
+                        help='intra-op threads of each worker, defaults to an even split of torch.get_num_threads()')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--n_batches', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=42)
+
+    args = parser.parse_args()
+    print(args)
+
+    benchmark(args=args)
@@ -16,6 +16,7 @@ import wandb
 
 from utils import RelationExtractionDataset, DataHelper, ConfigParser
 from model.metric import compute_metrics
+from model.stacking import FrozenMembersMixin, StackedEnsemble, read_ensemble_spec, read_member_dirs
 import os
 import random
 import numpy as np
@@ -90,19 +91,29 @@ class SplitModelsTest(RobertaPreTrainedModel):
         return outputs
 
 
-class SplitModels(nn.Module):
-    def __init__(self, k=0):
+class SplitModels(FrozenMembersMixin, nn.Module):
+    member_names = ('roberta1', 'roberta2', 'roberta3')
+
+    def __init__(self, k=0, member_dirs=None):
+        """
+        member_dirs: the member checkpoints, defaults to the k-th fold of each split model
+        """
         super(SplitModels, self).__init__()
 
+        self.member_dirs = member_dirs or [
+            "split_model_no_rel_large/" + str(k) + "_fold",
+            "split_model_rel_large/" + str(k) + "_fold",
+            "sota_focal/" + str(k) + "_fold",
+        ]
         c1 = AutoConfig.from_pretrained('klue/roberta-large', num_labels=2)
         c2 = AutoConfig.from_pretrained('klue/roberta-large', num_labels=29)
         c3 = AutoConfig.from_pretrained('klue/roberta-large', num_labels=30)
         self.roberta1 = AutoModelForSequenceClassification.from_pretrained(
-            "split_model_no_rel_large/" + str(k) + "_fold", config=c1)
+            self.member_dirs[0], config=c1)
         self.roberta2 = AutoModelForSequenceClassification.from_pretrained(
-            "split_model_rel_large/" + str(k) + "_fold", config=c2)
+            self.member_dirs[1], config=c2)
         self.roberta3 = AutoModelForSequenceClassification.from_pretrained(
-            "sota_focal/" + str(k) + "_fold", config=c3)
+            self.member_dirs[2], config=c3)
         for p in self.roberta1.parameters():
             p.requires_grad = False
         for p in self.roberta2.parameters():
@@ -467,6 +478,19 @@ def inference(args):
     _test_data = helper.from_idxs()
     test_data = helper.tokenize(data=_test_data, tokenizer=tokenizer)
     test_dataset = RelationExtractionDataset(test_data)
+    label_codec = load_label_codec(args.dictionary)
+
+    def save_output(name, probs):
+        if args.output_format == 'csv':
+            write_submission(path.join(args.output_dir, name + '_submission.csv'),
+                             _test_data['id'], probs, label_codec.labels)
+            return
+        predictions = path.join(args.output_dir, name + '.npz')
+        save_predictions(predictions, _test_data['id'], probs,
+                         label_codec.labels, dtype=args.probs_dtype)
+        if args.submission:
+            predictions_to_submission(
+                predictions, path.join(args.output_dir, name + '_submission.csv'))
 
     probs = []
     for k in range(args.n_splits if args.mode == 'skf' else 1):
@@ -474,49 +498,35 @@ def inference(args):
         #     path.join(args.model_dir,
         #               f'{k}_fold' if args.mode == 'skf' else args.mode)
         # )
-        model = SplitModels(k=k)
-        model.load_state_dict(torch.load(
-            'tmp/' + str(k) + '_fold/checkpoint-912/pytorch_model.bin'))
+        # head only checkpoints name the members they were trained on, each backbone is loaded once
+        model_dir = path.join(args.model_dir, f'{k}_fold', args.checkpoint)
+        spec = read_ensemble_spec(model_dir)
+        if args.ensemble_spec:
+            model = StackedEnsemble.from_spec(args.ensemble_spec, k=k)
+        elif spec is not None:
+            model = StackedEnsemble(spec)
+        else:
+            model = SplitModels(k=k, member_dirs=read_member_dirs(model_dir))
+        model.load_head(model_dir)
         model.to(device)
+        if args.member_workers > 1 and isinstance(model, StackedEnsemble):
+            model.parallel(args.member_workers, intra_op_threads=args.intra_op_threads)
 
-        pred_labels, pred_probs = infer(
+        _, pred_probs = infer(
             model=model,
             test_dataset=test_dataset,
             batch_size=args.batch_size,
             collate_fn=data_collator,
             device=device
         )
-        pred_labels = helper.convert_labels_by_dict(
-            labels=pred_labels,
-            dictionary=args.dictionary
-        )
+        if isinstance(model, StackedEnsemble):
+            model.parallel(1)
         probs.append(pred_probs)
-
-        output = pd.DataFrame({
-            'id': _test_data['id'],
-            'pred_label': pred_labels,
-            'probs': pred_probs
-        })
-        output.to_csv(
-            path.join(args.output_dir, (f'{k}_fold' if args.mode ==
-                      'skf' else args.mode) + '_submission.csv'),
-            index=False
-        )
+        save_output(f'{k}_fold' if args.mode == 'skf' else args.mode, pred_probs)
 
     if args.mode == 'skf':
-        probs = torch.tensor(probs).mean(dim=0)
-        preds = torch.argmax(probs, dim=-1).tolist()
-        preds = helper.convert_labels_by_dict(
-            labels=preds,
-            dictionary=args.dictionary
-        )
-        output = pd.DataFrame({
-            'id': _test_data['id'],
-            'pred_label': preds,
-            'probs': probs.tolist()
-        })
-        output.to_csv(path.join(args.output_dir,
-                      f'{args.n_splits}_folds_submission.csv'), index=False)
+        probs = torch.tensor(probs).mean(dim=0).numpy()
+        save_output(f'{args.n_splits}_folds', probs)
 
     print('Inference done')
 
@@ -529,13 +539,28 @@ if __name__ == '__main__':
                         default='data/dict_num_to_label.pkl')
     parser.add_argument('--output_dir', type=str,
                         default='./tmp')
+    parser.add_argument('--model_dir', type=str, default='./tmp',
+                        help='fold heads are read from <model_dir>/<k>_fold/<checkpoint>')
+    parser.add_argument('--checkpoint', type=str, default='checkpoint-912')
+    parser.add_argument('--ensemble_spec', type=str, default='',
+                        help='build the model from this spec with {k} member paths set to the fold, '
+                             'by default from the spec saved with the head, else SplitModels')
 
     parser.add_argument('--model_name', type=str, default='klue/bert-base')
     parser.add_argument('--mode', type=str, default='plain',
                         choices=['plain', 'skf'])
     parser.add_argument('--n_splits', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--member_workers', type=int, default=1,
+                        help='run the members of a spec built model on this many threads at once (cpu)')
+    parser.add_argument('--intra_op_threads', type=int, default=None,
+                        help='intra-op threads of each member worker, defaults to an even split of torch.get_num_threads()')
     parser.add_argument('--add_ent_token', type=bool, default=True)
+    parser.add_argument('--output_format', type=str, default='csv', choices=['csv', 'npz'],
+                        help='npz writes ids, label indices and probs as binary columns, read back with utils.load_predictions')
+    parser.add_argument('--probs_dtype', type=str, default='float32', choices=['float16', 'float32'])
+    parser.add_argument('--submission', action='store_true',
+                        help='with --output_format npz, also render the submission csv from the npz')
 
     args = parser.parse_args()
     print(args)
@@ -6,7 +6,7 @@ from torch import nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
-from transformers import AutoTokenizer, AutoConfig, AutoModelForSequenceClassification, DataCollatorWithPadding, Trainer, TrainingArguments
+from transformers import AutoTokenizer, AutoConfig, AutoModelForSequenceClassification, DataCollatorWithPadding, Trainer, TrainingArguments, default_data_collator
 from datasets.load import load_metric
 
 from tqdm import tqdm
@@ -16,6 +16,7 @@ import wandb
 
 from utils import RelationExtractionDataset, DataHelper, ConfigParser
 from model.metric import compute_metrics
+from model.stacking import MemberLogitsCache, MemberLogitsDataset, FrozenMembersMixin, StackedEnsemble, compute_member_logits
 import os
 import random
 import numpy as np
@@ -129,7 +130,10 @@ class MyTrainer(Trainer):
     def compute_loss(self, model, inputs, return_outputs=False):
         labels = inputs.get("labels")
         # outputs = model(**inputs)
-        outputs = model(inputs['input_ids'], inputs['attention_mask'])
+        if 'member_logits' in inputs:
+            outputs = model(member_logits=inputs['member_logits'])
+        else:
+            outputs = model(inputs['input_ids'], inputs['attention_mask'])
         logits = outputs.get("logits")
 
         loss_type = "focal"
@@ -144,6 +148,11 @@ class MyTrainer(Trainer):
 
         return (loss_fct, outputs) if return_outputs else loss_fct
 
+    def _save(self, output_dir=None, state_dict=None):
+        super()._save(output_dir, state_dict=state_dict)
+        if hasattr(self.model, 'save_members'):
+            self.model.save_members(output_dir or self.args.output_dir)
+
     # def evaluation_loop(self, *args, **kwargs):
     #     eval_loop_output = super().evaluation_loop(*args, **kwargs)
 
@@ -243,19 +252,33 @@ class SplitModelsTest(RobertaPreTrainedModel):
         return outputs
 
 
-class SplitModels(nn.Module):
+# frozen members of SplitModels, in the order their logits are concatenated
+MEMBER_DIRS = [
+    "split_model_no_rel_large/4_fold",
+    "split_model_rel_large/4_fold",
+    "sota_focal/4_fold",
+]
+# SplitModels as a spec, its members are MEMBER_DIRS with the default --member_fold
+SPLIT_MODELS_SPEC = 'config/ensemble/split_models.json'
+
+
+class SplitModels(FrozenMembersMixin, nn.Module):
+    # checkpoints hold fc1-3 and the classifier, the robertas are saved as MEMBER_DIRS references
+    member_names = ('roberta1', 'roberta2', 'roberta3')
+
     def __init__(self):
         super(SplitModels, self).__init__()
 
+        self.member_dirs = list(MEMBER_DIRS)
         c1 = AutoConfig.from_pretrained('klue/roberta-large', num_labels=2)
         c2 = AutoConfig.from_pretrained('klue/roberta-large', num_labels=29)
         c3 = AutoConfig.from_pretrained('klue/roberta-large', num_labels=30)
         self.roberta1 = AutoModelForSequenceClassification.from_pretrained(
-            "split_model_no_rel_large/4_fold", config=c1)
+            MEMBER_DIRS[0], config=c1)
         self.roberta2 = AutoModelForSequenceClassification.from_pretrained(
-            "split_model_rel_large/4_fold", config=c2)
+            MEMBER_DIRS[1], config=c2)
         self.roberta3 = AutoModelForSequenceClassification.from_pretrained(
-            "sota_focal/4_fold", config=c3)
+            MEMBER_DIRS[2], config=c3)
         for p in self.roberta1.parameters():
             p.requires_grad = False
         for p in self.roberta2.parameters():
@@ -468,13 +491,24 @@ class SplitModels(nn.Module):
         #     nn.Linear(768, 30, bias=True)
         # )
 
-    def forward(self, input_ids, attention_mask):
-        logits_a = self.roberta1(
-            input_ids.clone(), attention_mask=attention_mask).get('logits')
-        logits_b = self.roberta2(
-            input_ids.clone(), attention_mask=attention_mask).get('logits')
-        logits_c = self.roberta3(
-            input_ids.clone(), attention_mask=attention_mask).get('logits')
+    def members(self):
+        return [self.roberta1, self.roberta2, self.roberta3]
+
+    def forward(self, input_ids=None, attention_mask=None, member_logits=None):
+        """
+        member_logits: the frozen members' logits precomputed by compute_member_logits,
+                       [batch, 2 + 29 + 30], the members are skipped when given
+        """
+        if member_logits is None:
+            logits_a = self.roberta1(
+                input_ids, attention_mask=attention_mask).get('logits')
+            logits_b = self.roberta2(
+                input_ids, attention_mask=attention_mask).get('logits')
+            logits_c = self.roberta3(
+                input_ids, attention_mask=attention_mask).get('logits')
+        else:
+            logits_a, logits_b, logits_c = torch.split(
+                member_logits.to(self.fc1.weight.dtype), [2, 29, 30], dim=-1)
 
         logits_a = self.fc1(logits_a)
         logits_b = self.fc2(logits_b)
@@ -612,7 +646,10 @@ def evaluate(model, val_dataset, batch_size, collate_fn, device, eval_method='f1
         data = {key: value.to(device) for key, value in data.items()}
         with torch.no_grad():
             # outputs = model(**data)
-            outputs = model(data['input_ids'], data['attention_mask'])
+            if 'member_logits' in data:
+                outputs = model(member_logits=data['member_logits'])
+            else:
+                outputs = model(data['input_ids'], data['attention_mask'])
         preds = torch.argmax(outputs.logits, dim=-1)
         # preds = torch.argmax(outputs, dim=-1)
         metric.add_batch(predictions=preds, references=data['labels'])
@@ -641,18 +678,39 @@ def train(args):
     val_scores = []
     helper = DataHelper(data_dir=args.data_dir,
                         add_ent_token=args.add_ent_token,
-                        aug_data_dir=args.aug_data_dir)
+                        add_data_dir=args.aug_data_dir)
+
+    dataset = helper.to_dataset(tokenizer=tokenizer)
+
+    # spec members load lazily, so heads trained on cached logits never load a backbone.
+    # without a spec those heads use SPLIT_MODELS_SPEC, the SplitModels layout as a StackedEnsemble
+    ensemble_spec = args.ensemble_spec or (SPLIT_MODELS_SPEC if args.member_logits_cache else '')
+
+    def build_model():
+        if ensemble_spec:
+            return StackedEnsemble.from_spec(ensemble_spec, k=args.member_fold)
+        return SplitModels()
+
+    if args.member_logits_cache:
+        # the members are frozen and the same for every fold: run each one once over all rows,
+        # the heads are then trained on the stored logits without touching a backbone
+        cache = MemberLogitsCache(args.member_logits_cache)
+        member_dirs = StackedEnsemble.from_spec(ensemble_spec, k=args.member_fold).member_dirs
+        key = cache.key(member_dirs, helper.fingerprint(), tokenizer=tokenizer.name_or_path,
+                        add_ent_token=args.add_ent_token)
+        member_logits = cache.load(key)
+        if member_logits is None:
+            members = build_model()
+            members.to(device)
+            member_logits = cache.save(key, compute_member_logits(
+                members.members(), dataset, hp_config['batch_size'], data_collator, device))
+            del members
+        dataset = MemberLogitsDataset(member_logits, labels=dataset.labels)
+        data_collator = default_data_collator
 
     for k, (train_idxs, val_idxs) in enumerate(helper.split(ratio=args.split_ratio, n_splits=args.n_splits, mode=args.mode, random_seed=hp_config['seed'])):
-        train_data, train_labels = helper.from_idxs(idxs=train_idxs)
-        val_data, val_labels = helper.from_idxs(idxs=val_idxs)
-
-        train_data = helper.tokenize(train_data, tokenizer=tokenizer)
-        val_data = helper.tokenize(val_data, tokenizer=tokenizer)
-
-        train_dataset = RelationExtractionDataset(
-            train_data, labels=train_labels)
-        val_dataset = RelationExtractionDataset(val_data, labels=val_labels)
+        train_dataset = dataset.select(train_idxs)
+        val_dataset = dataset.select(val_idxs)
 
         # model = AutoModelForSequenceClassification.from_pretrained(
         #     'tmp2/checkpoint-912', config=model_config)
@@ -660,7 +718,7 @@ def train(args):
         #     args.model_name, config=model_config)
         # model = RobertaAddLSTMModel(pretrained_model_config=model_config)
 
-        model = SplitModels()
+        model = build_model()
         # model = SplitModelsTest(config=model_config)
 
         if args.entity_embedding:
@@ -734,7 +792,7 @@ def train(args):
             data_collator=data_collator
         )
         trainer.train()
-        model.save_pretrained(
+        model.save_head(
             path.join(args.save_dir, f'{k}_fold' if args.mode == 'skf' else args.mode))
 
         score = evaluate(
@@ -803,6 +861,13 @@ if __name__ == '__main__':
     parser.add_argument('--add_ent_token', type=bool, default=True)
     parser.add_argument('--disable_wandb', type=bool, default=True)
     parser.add_argument('--entity_embedding', type=bool, default=False)
+    parser.add_argument('--ensemble_spec', type=str, default='',
+                        help="members, head and fusion of the combine model (config/ensemble/*.json), '' uses SplitModels, "
+                             "or its spec when training on cached member logits")
+    parser.add_argument('--member_fold', type=int, default=4,
+                        help='fold filled into {k} member paths of the ensemble spec')
+    parser.add_argument('--member_logits_cache', type=str, default='cache/member_logits',
+                        help="train the head on frozen member logits stored here, '' runs the members every step")
 
     args = parser.parse_args()
 
@@ -7,6 +7,7 @@ import torch.nn.functional as F
 
 from transformers import AutoTokenizer, AutoModelForSequenceClassification, DataCollatorWithPadding
 import pandas as pd
+import numpy as np
 from tqdm import tqdm
 
 from split_utils import *
@@ -33,6 +34,41 @@ def infer(model, test_dataset, batch_size, collate_fn, device):
     return torch.cat(preds).tolist(), torch.cat(probs, dim=0).tolist()
 
 
+def is_relation(no_rel_probs, threshold=None):
+    """
+    rows the no_rel model predicts as relation, by argmax or by p(relation) >= threshold
+    """
+    no_rel_probs = np.asarray(no_rel_probs)
+    if threshold is None:
+        return no_rel_probs[:, 0] >= no_rel_probs[:, 1]
+    return no_rel_probs[:, 0] >= threshold
+
+
+def calc_total_probs(no_rel_probs, rel_probs, threshold=None):
+    """
+    30-way probs from the binary no_rel probs [N, 2] (relation, no_relation) and the 29-way rel probs [N, 29]
+    rows predicted as relation: [p(relation), p(no_relation) * rel probs]
+    rows predicted as no_relation: [p(no_relation), p(relation) / 30, ...]
+    """
+    no_rel_probs, rel_probs = np.asarray(no_rel_probs), np.asarray(rel_probs)
+    is_rel = is_relation(no_rel_probs, threshold)
+
+    total_probs = np.empty((len(rel_probs), rel_probs.shape[1] + 1), dtype=rel_probs.dtype)
+    total_probs[:, 0] = np.where(is_rel, no_rel_probs[:, 0], no_rel_probs[:, 1])
+    total_probs[:, 1:] = np.where(
+        is_rel[:, None], no_rel_probs[:, 1:] * rel_probs, no_rel_probs[:, :1] / 30)
+    return total_probs
+
+
+def calc_total_preds(no_rel_probs, rel_preds, rel_to_total, no_relation, threshold=None):
+    """
+    30-way label indices: the rel model prediction where the no_rel model predicts relation, no_relation elsewhere
+    rel_to_total maps 29-way rel indices to 30-way indices
+    """
+    is_rel = is_relation(no_rel_probs, threshold)
+    return np.where(is_rel, np.asarray(rel_to_total)[rel_preds], no_relation)
+
+
 def inference(args):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -44,6 +80,24 @@ def inference(args):
     _test_data = helper.from_idxs()
     test_data = helper.tokenize(data=_test_data, tokenizer=tokenizer)
     test_dataset = RelationExtractionDataset(test_data)
+    # the label order the rel model was trained with, see split_utils.load_rel_codec
+    rel_labels = load_rel_codec(args.dictionary).labels
+    total_codec = load_label_codec('data/dict_num_to_label.pkl')
+    rel_to_total = total_codec.encode(rel_labels)
+    no_relation = total_codec.encode(['no_relation'])[0]
+
+    def save_output(output_dir, name, probs, labels, preds=None, ids=None):
+        ids = _test_data['id'] if ids is None else ids
+        if args.output_format == 'csv':
+            write_submission(path.join(output_dir, name + '_submission.csv'),
+                             ids, probs, labels, preds=preds)
+            return
+        predictions = path.join(output_dir, name + '.npz')
+        save_predictions(predictions, ids, probs,
+                         labels, preds=preds, dtype=args.probs_dtype)
+        if args.submission:
+            predictions_to_submission(
+                predictions, path.join(output_dir, name + '_submission.csv'))
 
     no_rel_probs = []
     rel_probs = []
@@ -67,133 +121,64 @@ def inference(args):
             collate_fn=data_collator,
             device=device
         )
-        rel_pred_labels, rel_pred_probs = infer(
-            model=rel_model,
-            test_dataset=test_dataset,
-            batch_size=args.batch_size,
-            collate_fn=data_collator,
-            device=device
-        )
-
-        rel_pred_labels = helper.convert_labels_by_dict(
-            labels=rel_pred_labels,
-            dictionary=args.dictionary,
-            is_rel=True
-        )
-        no_rel_pred_labels = helper.convert_labels_by_dict(
-            labels=no_rel_pred_labels,
-            is_rel=False
-        )
-
+        no_rel_pred_probs = np.asarray(no_rel_pred_probs)
         no_rel_probs.append(no_rel_pred_probs)
-        rel_probs.append(rel_pred_probs)
-
-        no_rel_output = pd.DataFrame({
-            'id': _test_data['id'],
-            'pred_label': no_rel_pred_labels,
-            'probs': no_rel_pred_probs
-        })
-        no_rel_output.to_csv(
-            path.join(args.no_rel_output_dir, (f'{k}_fold' if args.mode ==
-                      'skf' else args.mode) + '_submission.csv'),
-            index=False
-        )
+        save_output(args.no_rel_output_dir, f'{k}_fold' if args.mode == 'skf' else args.mode,
+                    no_rel_pred_probs, NO_REL_CODEC.labels)
+
+        if args.cascade_threshold is None:
+            rel_pred_labels, rel_pred_probs = infer(
+                model=rel_model,
+                test_dataset=test_dataset,
+                batch_size=args.batch_size,
+                collate_fn=data_collator,
+                device=device
+            )
+            rel_pred_probs = np.asarray(rel_pred_probs)
+            rel_probs.append(rel_pred_probs)
+            save_output(args.rel_output_dir, f'{k}_fold' if args.mode == 'skf' else args.mode,
+                        rel_pred_probs, rel_labels)
+        else:
+            # cascade: the rel model only sees rows the no_rel model passes, the rest fall back to no_relation
+            rel_rows = np.flatnonzero(is_relation(no_rel_pred_probs, args.cascade_threshold))
+            print(f'{k} fold: rel model on {len(rel_rows)} / {len(test_dataset)} rows')
+            rel_pred_labels = np.zeros(len(test_dataset), dtype=np.int64)
+            rel_pred_probs = np.zeros((len(test_dataset), len(rel_labels)))
+            if len(rel_rows):
+                cascade_labels, cascade_probs = infer(
+                    model=rel_model,
+                    test_dataset=test_dataset.select(rel_rows),
+                    batch_size=args.batch_size,
+                    collate_fn=data_collator,
+                    device=device
+                )
+                rel_pred_labels[rel_rows] = cascade_labels
+                rel_pred_probs[rel_rows] = cascade_probs
+            save_output(args.rel_output_dir, f'{k}_fold' if args.mode == 'skf' else args.mode,
+                        rel_pred_probs[rel_rows], rel_labels,
+                        ids=_test_data['id'].to_numpy()[rel_rows])
+
+        total_probs.append(calc_total_probs(
+            no_rel_pred_probs, rel_pred_probs, args.cascade_threshold))
+        total_preds = calc_total_preds(
+            no_rel_pred_probs, rel_pred_labels, rel_to_total, no_relation, args.cascade_threshold)
+        save_output('split_total_inf', f'{k}_fold' if args.mode == 'skf' else args.mode,
+                    total_probs[k], total_codec.labels, preds=total_preds)
 
-        rel_output = pd.DataFrame({
-            'id': _test_data['id'],
-            'pred_label': rel_pred_labels,
-            'probs': rel_pred_probs
-        })
-        rel_output.to_csv(
-            path.join(args.rel_output_dir, (f'{k}_fold' if args.mode ==
-                      'skf' else args.mode) + '_submission.csv'),
-            index=False
-        )
+    if args.mode == 'skf':
+        no_rel_probs = torch.tensor(np.stack(no_rel_probs), dtype=torch.float32).mean(dim=0).numpy()
+        save_output(args.no_rel_output_dir, f'{args.n_splits}_folds',
+                    no_rel_probs, NO_REL_CODEC.labels)
 
-        def make_total_output(no_rel_output, rel_output, total_probs, k):
-            print(no_rel_output.head())
-            print(rel_output.head())
-            rel_idx = no_rel_output.loc[no_rel_output['pred_label']
-                                        != 'no_relation', :].index
-            rel_df = rel_output.loc[rel_idx]
-            no_rel_output[(no_rel_output['pred_label']
-                           != 'no_relation')] = rel_df
-            no_rel_output['probs'] = total_probs[k]
-            return no_rel_output
-
-        def calc_total_probs(no_rel, rel, k):
-            # total_prob = [] * len(no_rel[k])
-            total_prob = [[] for _ in range(len(no_rel[k]))]
-
-            for i in range(len(no_rel[k])):
-                if no_rel[k][i][0] >= no_rel[k][i][1]:  # rel
-                    total_prob[i].append(no_rel[k][i][0])
-                    for j in range(len(rel[k][i])):
-                        total_prob[i].append(no_rel[k][i][1] * rel[k][i][j])
-
-                else:  # no_rel
-                    total_prob[i].append(no_rel[k][i][1])
-                    for _ in range(len(rel[k][i])):
-                        total_prob[i].append(no_rel[k][i][0] / 30)
-            return total_prob
-
-        total_probs.append(calc_total_probs(no_rel_probs, rel_probs, k))
-        total_output = make_total_output(
-            no_rel_output, rel_output, total_probs, k)
-        total_output.to_csv(
-            path.join('split_total_inf', (f'{k}_fold' if args.mode ==
-                      'skf' else args.mode) + '_submission.csv'),
-            index=False
-        )
+        # in cascade mode every fold's rel model saw different rows, there is no fold average
+        if args.cascade_threshold is None:
+            rel_probs = torch.tensor(np.stack(rel_probs), dtype=torch.float32).mean(dim=0).numpy()
+            save_output(args.rel_output_dir, f'{args.n_splits}_folds',
+                        rel_probs, rel_labels)
 
-    if args.mode == 'skf':
-        no_rel_probs = torch.tensor(no_rel_probs).mean(dim=0)
-        no_rel_preds = torch.argmax(no_rel_probs, dim=-1).tolist()
-        no_rel_preds = helper.convert_labels_by_dict(
-            labels=no_rel_preds,
-            dictionary=args.dictionary,
-            is_rel=False
-        )
-        no_rel_output = pd.DataFrame({
-            'id': _test_data['id'],
-            'pred_label': no_rel_preds,
-            'probs': no_rel_probs.tolist()
-        })
-        no_rel_output.to_csv(path.join(args.no_rel_output_dir,
-                                       f'{args.n_splits}_folds_submission.csv'), index=False)
-
-        rel_probs = torch.tensor(rel_probs).mean(dim=0)
-        rel_preds = torch.argmax(rel_probs, dim=-1).tolist()
-        rel_preds = helper.convert_labels_by_dict(
-            labels=rel_preds,
-            dictionary=args.dictionary
-        )
-        rel_output = pd.DataFrame({
-            'id': _test_data['id'],
-            'pred_label': rel_preds,
-            'probs': rel_probs.tolist()
-        })
-        rel_output.to_csv(path.join(args.rel_output_dir,
-                                    f'{args.n_splits}_folds_submission.csv'), index=False)
-
-        total_probs = torch.tensor(total_probs).mean(dim=0)
-        total_preds = torch.argmax(total_probs, dim=-1).tolist()
-
-        def convert_labels_by_dict(labels, dictionary='data/dict_label_to_num.pkl'):
-            with open(dictionary, 'rb') as f:
-                dictionary = pickle.load(f)
-            return np.array([dictionary[label] for label in labels])
-
-        total_preds = convert_labels_by_dict(
-            labels=total_preds
-        )
-        total_output = pd.DataFrame({
-            'id': _test_data['id'],
-            'pred_label': total_preds,
-            'probs': total_probs.tolist()
-        })
-        total_output.to_csv(path.join('split_total_inf',
-                                      f'{args.n_splits}_folds_submission.csv'), index=False)
+        total_probs = torch.tensor(np.stack(total_probs), dtype=torch.float32).mean(dim=0).numpy()
+        save_output('split_total_inf', f'{args.n_splits}_folds',
+                    total_probs, total_codec.labels)
 
     print('Inference done')
 
@@ -203,8 +188,9 @@ if __name__ == '__main__':
 
     parser.add_argument('--data_dir', type=str, default='data/test_data.csv')
     parser.add_argument('--is_rel', type=bool, default=False)
-    parser.add_argument('--dictionary', type=str,
-                        default='data/only_rel_num_to_label_start_0.pkl')
+    parser.add_argument('--dictionary', type=str, default=REL_DICTIONARY,
+                        help='rel label dictionary the rel model was trained with, '
+                             'dict_label_to_num.pkl without no_relation if it does not exist')
     parser.add_argument('--no_rel_output_dir', type=str,
                         default='./split_model_no_rel_large_inf')
     parser.add_argument('--no_rel_model_dir', type=str,
@@ -220,6 +206,13 @@ if __name__ == '__main__':
     parser.add_argument('--n_splits', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=64)
     parser.add_argument('--add_ent_token', type=bool, default=True)
+    parser.add_argument('--cascade_threshold', type=float, default=None,
+                        help='run the rel model only on rows with p(relation) >= threshold, the rest are no_relation')
+    parser.add_argument('--output_format', type=str, default='csv', choices=['csv', 'npz'],
+                        help='npz writes ids, label indices and probs as binary columns, read back with utils.load_predictions')
+    parser.add_argument('--probs_dtype', type=str, default='float32', choices=['float16', 'float32'])
+    parser.add_argument('--submission', action='store_true',
+                        help='with --output_format npz, also render the submission csv from the npz')
 
     args = parser.parse_args()
     print(args)
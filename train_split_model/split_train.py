@@ -100,16 +100,11 @@ def train(args):
                         aug_data_dir=args.aug_data_dir,
                         is_rel=args.is_rel)
 
-    for k, (train_idxs, val_idxs) in enumerate(helper.split(ratio=args.split_ratio, n_splits=args.n_splits, mode=args.mode, random_seed=hp_config['seed'])):
-        train_data, train_labels = helper.from_idxs(idxs=train_idxs)
-        val_data, val_labels = helper.from_idxs(idxs=val_idxs)
-
-        train_data = helper.tokenize(train_data, tokenizer=tokenizer)
-        val_data = helper.tokenize(val_data, tokenizer=tokenizer)
+    dataset = helper.to_dataset(tokenizer=tokenizer)
 
-        train_dataset = RelationExtractionDataset(
-            train_data, labels=train_labels)
-        val_dataset = RelationExtractionDataset(val_data, labels=val_labels)
+    for k, (train_idxs, val_idxs) in enumerate(helper.split(ratio=args.split_ratio, n_splits=args.n_splits, mode=args.mode, random_seed=hp_config['seed'])):
+        train_dataset = dataset.select(train_idxs)
+        val_dataset = dataset.select(val_idxs)
 
         model = AutoModelForSequenceClassification.from_pretrained(
             args.model_name, config=model_config)
@@ -1,152 +1,50 @@
-import ast
-import pickle
+import sys
+from os import path
 
-import torch
-from torch.utils.data import Dataset
-
-from sklearn.model_selection import train_test_split, StratifiedKFold
-import pandas as pd
 import numpy as np
-import json
 
+# the split scripts run as `python train_split_model/<script>.py` from the repo root, which puts this
+# directory on sys.path but not the root the shared utils live in
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-class ConfigParser():
-    def __init__(self, config):
-        self.config = self.json_to_dict(config)
+from utils import ConfigParser, RelationExtractionDataset, DataHelper as BaseDataHelper, NO_REL_CODEC, load_label_codec
+from utils import save_predictions, load_predictions, write_submission, predictions_to_submission
 
-    def json_to_dict(self, config):
-        with open(config) as json_config:
-            return json.load(json_config)
+# label -> num of the 29 relation labels, starting from 0
+REL_DICTIONARY = 'data/only_rel_label_to_num_start_0.pkl'
 
 
-class RelationExtractionDataset(Dataset):
+def load_rel_codec(dictionary=REL_DICTIONARY):
     """
-    A dataset class for loading Relation Extraction data
+    Codec of the rel model, used to encode its training labels and to decode its predictions:
+    the given dictionary if it exists, else dict_label_to_num.pkl without no_relation
     """
+    if path.isfile(dictionary):
+        return load_label_codec(dictionary)
+    return load_label_codec().rel_only()
 
-    def __init__(self, data, labels=None):
-        self.data = data
-        self.labels = labels
-
-    def __getitem__(self, idx):
-        item = {key: value[idx] for key, value in self.data.items()}
-        if self.labels is not None:
-            item['labels'] = torch.tensor(self.labels[idx])
-        return item
-
-    def __len__(self):
-        return len(self.data['input_ids'])
 
-
-class DataHelper:
+class DataHelper(BaseDataHelper):
     """
-    A helper class for data loading and processing
+    A helper class for data loading and processing of the split (no_rel / rel) models
     """
 
-    def __init__(self, data_dir, mode='train', add_ent_token=False, aug_data_dir='', is_rel=False):
-        self._data = pd.read_csv(data_dir)
-        if aug_data_dir:
-            self._aug_data = pd.read_csv(aug_data_dir)
-            self._data = pd.concat([self._data, self._aug_data])
-        self._mode = mode
-        self.add_ent_token = add_ent_token
+    def __init__(self, data_dir, mode='train', add_ent_token=False, aug_data_dir='', is_rel=False,
+                 cache_dir='cache/tokenized', num_workers=1):
         self.is_rel = is_rel
-        self._preprocess()
-
-    def _preprocess(self):
-        data = self._data
-        if self.add_ent_token:
-            data = self.ent_preprocess(data)
-
-        def extract(d): return ast.literal_eval(d)['word']
-
-        subjects = list(map(extract, data['subject_entity']))
-        objects = list(map(extract, data['object_entity']))
-
-        self._processed = pd.DataFrame({
-            'id': data['id'],
-            'sentence': data['sentence'],
-            'subject_entity': subjects,
-            'object_entity': objects,
-        })
-        if self._mode == 'train':
-            if self.is_rel:
-                self._labels = self.convert_labels_by_dict(
-                    labels=data['label'])
-            else:
-                self._labels = np.array(data['no_rel_label'].values)
-
-    def split(self, ratio=0.2, n_splits=5, mode='plain', random_seed=42):
-        if mode == 'plain':
-            idxs_list = [train_test_split(
-                np.arange(len(self._data)),
-                test_size=ratio,
-                shuffle=True
-            )]
-        elif mode == 'skf':
-            skf = StratifiedKFold(
-                n_splits=n_splits, shuffle=True, random_state=random_seed)
-            idxs_list = skf.split(self._processed, self._labels)
-        return idxs_list
-
-    def from_idxs(self, idxs=None):
-        return (self._processed.iloc[idxs], self._labels[idxs]) if self._mode == 'train' else self._processed
-
-    def tokenize(self, data, tokenizer):
-        concated_entities = [sub + '[SEP]' + obj for sub,
-                             obj in zip(data['subject_entity'], data['object_entity'])]
-        if self.add_ent_token:
-            tokenized = tokenizer(
-                data['sentence'].tolist(),
-                truncation=True,
-                return_token_type_ids=False,
-            )
-        else:
-            tokenized = tokenizer(
-                concated_entities,
-                data['sentence'].tolist(),
-                truncation=True,
-                return_token_type_ids=False,
-            )
-        return tokenized
-
-    def convert_labels_by_dict(self, labels, dictionary='data/only_rel_label_to_num_start_0.pkl', is_rel=True):
-        # def convert_labels_by_dict(self, labels, dictionary='data/only_rel_label_to_num.pkl'):
-        if is_rel:
-            with open(dictionary, 'rb') as f:
-                dictionary = pickle.load(f)
-            return np.array([dictionary[label] for label in labels])
-        else:
-            dictionary = {
-                0: 'relation', 1: 'no_relation'
-            }
-            return np.array([dictionary[label] for label in labels])
-
-    def ent_preprocess(self, data):
-        data['sentence'] = data.apply(lambda row: self.add_entity_tokens(
-            row['sentence'], row['object_entity'], row['subject_entity']), axis=1)
-        return data
-
-    def add_entity_tokens(self, sentence, object_entity, subject_entity):
-
-        def entity_mapper(entity_type):
-            e_map = {'PER': '인물', 'ORG': '기관', 'LOC': '지명',
-                     'POH': '기타', 'DAT': '날짜', 'NOH': '수량'}
-            return e_map[entity_type]
-
-        def extract(entity):
-            return int(ast.literal_eval(entity)['start_idx']), int(ast.literal_eval(entity)['end_idx']), entity_mapper(ast.literal_eval(entity)['type'])
-
-        obj_start_idx, obj_end_idx, obj_type = extract(object_entity)
-        subj_start_idx, subj_end_idx, sbj_type = extract(subject_entity)
-
-        if obj_start_idx < subj_start_idx:
-            new_sentence = sentence[:obj_start_idx] + '#' + '*' + obj_type + '*' + sentence[obj_start_idx:obj_end_idx + 1] + '#' + \
-                sentence[obj_end_idx + 1:subj_start_idx] + '@' + '^' + sbj_type + '^' + sentence[subj_start_idx:subj_end_idx + 1] + \
-                '@' + sentence[subj_end_idx + 1:]
-        else:
-            new_sentence = sentence[:subj_start_idx] + '@' + '^' + sbj_type + '^' + sentence[subj_start_idx:subj_end_idx + 1] + '@' + \
-                sentence[subj_end_idx + 1:obj_start_idx] + '#' + '*' + obj_type + '*' + sentence[obj_start_idx:obj_end_idx + 1] + \
-                '#' + sentence[obj_end_idx + 1:]
-
-        return new_sentence
+        super().__init__(data_dir, mode=mode, add_ent_token=add_ent_token,
+                         add_data_dir=aug_data_dir, cache_dir=cache_dir, num_workers=num_workers)
+
+    def _extract_labels(self, data):
+        if self.is_rel:
+            return self.convert_labels_by_dict(labels=data['label'])
+        return np.array(data['no_rel_label'].values)
+
+    def convert_labels_by_dict(self, labels, dictionary=REL_DICTIONARY, is_rel=True):
+        """
+        is_rel: 29-way relation labels (label -> num, starting from 0) by load_rel_codec(dictionary)
+        else  : binary no_rel labels (num -> label)
+        """
+        if not is_rel:
+            return NO_REL_CODEC.decode(labels)
+        return load_rel_codec(dictionary).encode(labels)
@@ -1,2 +1,4 @@
 from .trainer import *
 from .training_arguments import *
+from .sampler import *
+from .manifest import *
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+from os import path
+
+
+def hash_config(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def move_aside(directory):
+    """
+    Rename directory to the first free <directory>.stale-<n> instead of deleting it, returns the new path
+    """
+    n = 0
+    while path.exists(f'{directory}.stale-{n}'):
+        n += 1
+    os.replace(directory, f'{directory}.stale-{n}')
+    return f'{directory}.stale-{n}'
+
+
+class FoldManifest:
+    """
+    Started and completed folds of a k-fold run, kept in save_dir/fold_manifest.json
+    a fold is marked started before it trains, its partial checkpoints are only resumed (and a completed
+    fold only reused) by a run with the same config and data hashes
+    """
+
+    def __init__(self, save_dir, config_hash, data_hash):
+        self.path = path.join(save_dir, 'fold_manifest.json')
+        self.config_hash = config_hash
+        self.data_hash = data_hash
+
+        manifest = {}
+        if path.isfile(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+        self.resumable = manifest.get('config_hash') == config_hash and manifest.get('data_hash') == data_hash
+        self.folds = manifest.get('folds', {}) if self.resumable else {}
+        self._write()
+
+    def _matches(self, entry):
+        return entry is not None and \
+            (entry['config_hash'], entry['data_hash']) == (self.config_hash, self.data_hash)
+
+    def completed(self, fold):
+        entry = self.folds.get(fold)
+        if not self._matches(entry) or 'score' not in entry or not path.isdir(entry['checkpoint']):
+            return None
+        return entry
+
+    def started(self, fold):
+        """
+        True if fold was started by a run with this config and data, its checkpoints can be resumed
+        """
+        return self._matches(self.folds.get(fold))
+
+    def start(self, fold):
+        self.folds[fold] = {
+            'config_hash': self.config_hash,
+            'data_hash': self.data_hash,
+        }
+        self._write()
+
+    def record(self, fold, checkpoint, score):
+        self.folds[fold] = {
+            'config_hash': self.config_hash,
+            'data_hash': self.data_hash,
+            'checkpoint': checkpoint,
+            'score': score,
+        }
+        self._write()
+
+    def _write(self):
+        os.makedirs(path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'config_hash': self.config_hash,
+                'data_hash': self.data_hash,
+                'folds': self.folds,
+            }, f, indent=4)
+        os.replace(tmp, self.path)
@@ -0,0 +1,65 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def padding_ratio(lengths, batches):
+    """
+    Fraction of padded positions when every batch is padded to its longest sentence
+    """
+    lengths = np.asarray(lengths)
+    padded = sum(lengths[batch].max() * len(batch) for batch in batches if len(batch))
+    return 1.0 - lengths.sum() / padded
+
+
+def chunk(indices, batch_size):
+    return [indices[i: i + batch_size] for i in range(0, len(indices), batch_size)]
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Random sampler that keeps sentences of similar length in the same batch
+    indices are shuffled, cut into buckets of batch_size * bucket_size, sorted by length
+    inside each bucket and split into batches, then the full batches are shuffled.
+    a short last batch always comes last so DataLoader batching stays aligned.
+    the order only depends on seed and epoch, so a resumed run replays the permutation of the epoch it
+    stopped in: newer Trainers call set_epoch at the start of every epoch, older ones iterate the sampler
+    once per skipped epoch, which moves the epoch on the same way
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=50, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+
+    def batches(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+        indices = rng.permutation(len(self.lengths))
+
+        batches, remainder = [], []
+        for bucket in chunk(indices, self.batch_size * self.bucket_size):
+            bucket = bucket[np.argsort(-self.lengths[bucket], kind='stable')]
+            for batch in chunk(bucket, self.batch_size):
+                (batches if len(batch) == self.batch_size else remainder).append(batch)
+        return [batches[i] for i in rng.permutation(len(batches))] + remainder
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        # without set_epoch calls, iterating again still moves on to the next epoch's order
+        self.epoch += 1
+        for batch in batches:
+            yield from batch.tolist()
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+def sorted_by_length(lengths):
+    """
+    Evaluation order from the longest to the shortest sentence
+    """
+    return np.argsort(-np.asarray(lengths), kind='stable').tolist()
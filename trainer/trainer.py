@@ -1,6 +1,7 @@
 import torch
 
 from transformers import Trainer
+from transformers.utils import logging
 
 import wandb
 import seaborn as sns
@@ -9,6 +10,9 @@ import numpy as np
 from sklearn.metrics import confusion_matrix
 
 from model.loss import CB_loss, LDAMLoss
+from .sampler import LengthBucketSampler, chunk, padding_ratio, sorted_by_length
+
+logger = logging.get_logger(__name__)
 
 
 class MyTrainer(Trainer):
@@ -32,6 +36,24 @@ class MyTrainer(Trainer):
 
         return (loss_fct, outputs) if return_outputs else loss_fct
 
+    def _get_train_sampler(self, *args, **kwargs):
+        if not self.args.group_by_length:
+            return super()._get_train_sampler(*args, **kwargs)
+
+        lengths = self.train_dataset.lengths()
+        batch_size = self.args.train_batch_size
+        sampler = LengthBucketSampler(lengths, batch_size, seed=self.args.seed)
+
+        random_batches = chunk(np.random.default_rng(self.args.seed).permutation(len(lengths)), batch_size)
+        logger.info(f'padding ratio: random batches {padding_ratio(lengths, random_batches):.1%}, '
+                    f'length buckets {padding_ratio(lengths, sampler.batches(0)):.1%}')
+        return sampler
+
+    def _get_eval_sampler(self, eval_dataset):
+        if not self.args.group_by_length:
+            return super()._get_eval_sampler(eval_dataset)
+        return sorted_by_length(eval_dataset.lengths())
+
     def evaluation_loop(self, *args, **kwargs):
         eval_loop_output = super().evaluation_loop(*args, **kwargs)
 
@@ -27,6 +27,7 @@ def init_epoch_training_arguments(training_arguments_config, hyperparameter_conf
         save_strategy=training_arguments_config['evaluation_strategy'],
         load_best_model_at_end=training_arguments_config['load_best_model_at_end'],
         metric_for_best_model=training_arguments_config['metric_for_best_model'],
+        group_by_length=training_arguments_config.get('group_by_length', False),
         fp16=training_arguments_config['fp16'],
         fp16_opt_level=training_arguments_config['fp16_opt_level']
     )
@@ -50,6 +51,7 @@ def init_steps_training_arguments(training_arguments_config, hyperparameter_conf
         save_steps=training_arguments_config['save_steps'],
         load_best_model_at_end=training_arguments_config['load_best_model_at_end'],
         metric_for_best_model=training_arguments_config['metric_for_best_model'],
+        group_by_length=training_arguments_config.get('group_by_length', False),
         fp16=training_arguments_config['fp16'],
         fp16_opt_level=training_arguments_config['fp16_opt_level']
     )
@@ -1,8 +1,16 @@
 import ast
+import functools
+import hashlib
+import os
 import pickle
+import re
+import shutil
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 import torch
 from torch.utils.data import Dataset
+from transformers import DataCollatorWithPadding
 
 from sklearn.model_selection import train_test_split, StratifiedKFold
 import pandas as pd
@@ -10,6 +18,299 @@ import numpy as np
 import json
 
 
+ENTITY_TYPES = {
+    "PER": "인물",
+    "ORG": "기관",
+    "LOC": "지명",
+    "POH": "기타",
+    "DAT": "날짜",
+    "NOH": "수량",
+}
+
+# part of the tokenized cache key, keep in sync with mark_entities
+MARKER_SCHEME = "@^type^subject@ #*type*object#"
+
+ENTITY_PATTERN = re.compile(
+    r"\{'word': (['\"])(.*)\1, 'start_idx': (\d+), 'end_idx': (\d+), 'type': '(\w+)'\}$"
+)
+
+
+def parse_entities(entities):
+    """
+    Parse a column of entity dict strings once into word, start_idx, end_idx and type columns
+    """
+    def extract(entity):
+        matched = ENTITY_PATTERN.match(entity)
+        # escaped words or other key orders are left to literal_eval
+        if matched is None or "\\" in matched.group(2):
+            entity = ast.literal_eval(entity)
+            return entity["word"], entity["start_idx"], entity["end_idx"], entity["type"]
+        return matched.group(2, 3, 4, 5)
+
+    parsed = pd.DataFrame(
+        [extract(entity) for entity in entities],
+        columns=["word", "start_idx", "end_idx", "type"],
+    )
+    parsed["start_idx"] = parsed["start_idx"].astype(np.int64)
+    parsed["end_idx"] = parsed["end_idx"].astype(np.int64)
+    return parsed
+
+
+def mark_entities(sentences, subjects, objects):
+    """
+    Columnar version of DataHelper.add_entity_tokens
+    input : subjects / objects parsed by parse_entities
+    output: sentences with subjects as @^type^word@ and objects as #*type*word#
+    """
+    def spans(entities, open_char, type_char):
+        codes, types = pd.factorize(entities["type"])
+        type_names = np.array([ENTITY_TYPES[t] for t in types], dtype=object)
+        openers = open_char + type_char + type_names + type_char
+        return (
+            entities["start_idx"].to_numpy(),
+            entities["end_idx"].to_numpy() + 1,
+            openers[codes],
+        )
+
+    sub_start, sub_end, sub_open = spans(subjects, "@", "^")
+    obj_start, obj_end, obj_open = spans(objects, "#", "*")
+
+    obj_first = obj_start < sub_start
+    first_start = np.where(obj_first, obj_start, sub_start).tolist()
+    first_end = np.where(obj_first, obj_end, sub_end).tolist()
+    first_open = np.where(obj_first, obj_open, sub_open).tolist()
+    first_close = np.where(obj_first, "#", "@").tolist()
+    second_start = np.where(obj_first, sub_start, obj_start).tolist()
+    second_end = np.where(obj_first, sub_end, obj_end).tolist()
+    second_open = np.where(obj_first, sub_open, obj_open).tolist()
+    second_close = np.where(obj_first, "@", "#").tolist()
+
+    return [
+        s[:fs] + fo + s[fs:fe] + fc + s[fe:ss] + so + s[ss:se] + sc + s[se:]
+        for s, fs, fe, fo, fc, ss, se, so, sc in zip(
+            sentences, first_start, first_end, first_open, first_close,
+            second_start, second_end, second_open, second_close,
+        )
+    ]
+
+
+def hash_frame(data):
+    """
+    Content hash of a DataFrame's rows, independent of its index
+    """
+    return hashlib.sha1(
+        pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes()
+    ).hexdigest()
+
+
+def preprocess_frame(data, add_ent_token):
+    """
+    Entity words and (optionally entity-marked) sentences of a raw KLUE RE frame
+    """
+    subjects = parse_entities(data["subject_entity"])
+    objects = parse_entities(data["object_entity"])
+    sentences = data["sentence"].tolist()
+    if add_ent_token:
+        sentences = mark_entities(sentences, subjects, objects)
+    return sentences, subjects["word"].tolist(), objects["word"].tolist()
+
+
+def tokenize_frame(data, tokenizer, add_ent_token):
+    if add_ent_token:
+        return tokenizer(
+            data["sentence"].tolist(), truncation=True, return_token_type_ids=False,
+        )
+    concated_entities = [
+        sub + "[SEP]" + obj
+        for sub, obj in zip(data["subject_entity"], data["object_entity"])
+    ]
+    return tokenizer(
+        concated_entities,
+        data["sentence"].tolist(),
+        truncation=True,
+        return_token_type_ids=False,
+    )
+
+
+def shard(data, num_workers, min_rows=2000):
+    """
+    Row chunks for a process pool, a few per worker to even out their load
+    """
+    n_shards = max(1, min(num_workers * 4, len(data) // min_rows))
+    return [data.iloc[idxs] for idxs in np.array_split(np.arange(len(data)), n_shards)]
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenize_worker(tokenizer):
+    global _worker_tokenizer
+    # one process per core already, keep the rust tokenizer single threaded
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_shard(data, add_ent_token):
+    return TokenStore.from_encoding(tokenize_frame(data, _worker_tokenizer, add_ent_token))
+
+
+ENTITY_MASK_MARKERS = ["<e1>", "</e1>", "<e2>", "</e2>"]
+
+
+def find_entity_spans(store, marker_ids):
+    """
+    Row-relative position of the first occurrence of each marker token, one column per marker
+    """
+    spans = np.empty((len(store), len(marker_ids)), dtype=np.int64)
+    for col, marker_id in enumerate(marker_ids):
+        positions = np.flatnonzero(store.input_ids == marker_id)
+        rows = np.searchsorted(store.offsets, positions, side="right") - 1
+        found, first = np.unique(rows, return_index=True)
+        if len(found) != len(store):
+            missing = np.setdiff1d(np.arange(len(store)), found)
+            raise ValueError(f"marker token {marker_id} not found in rows {missing[:10].tolist()}")
+        spans[:, col] = positions[first] - store.offsets[found]
+    return spans
+
+
+class EntityMaskCollator:
+    """
+    Pads a batch and builds e1_mask / e2_mask from the entity spans of its rows only
+    """
+
+    def __init__(self, tokenizer):
+        self.collator = DataCollatorWithPadding(tokenizer=tokenizer)
+
+    def __call__(self, features):
+        spans = torch.as_tensor(np.stack([feature.pop("entity_spans") for feature in features]))
+        batch = self.collator(features)
+        positions = torch.arange(batch["input_ids"].shape[1]).unsqueeze(0)
+        batch["e1_mask"] = ((positions >= spans[:, 0:1]) & (positions <= spans[:, 1:2])).long()
+        batch["e2_mask"] = ((positions >= spans[:, 2:3]) & (positions <= spans[:, 3:4])).long()
+        return batch
+
+
+class LabelCodec:
+    """
+    Mapping between label names and class indices, whole arrays are converted with numpy lookups
+    """
+
+    def __init__(self, labels, num_to_label=False):
+        self.labels = np.array(labels, dtype=object)
+        self.num_to_label = num_to_label
+        self._index = pd.Index(self.labels)
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        num_to_label = all(isinstance(key, (int, np.integer)) for key in dictionary)
+        if num_to_label:
+            labels = [dictionary[num] for num in sorted(dictionary)]
+        else:
+            labels = sorted(dictionary, key=dictionary.get)
+        return cls(labels, num_to_label=num_to_label)
+
+    def encode(self, labels):
+        nums = self._index.get_indexer(np.asarray(labels, dtype=object))
+        if (nums < 0).any():
+            raise KeyError(np.asarray(labels, dtype=object)[nums < 0][0])
+        return nums
+
+    def decode(self, nums):
+        return self.labels[np.asarray(nums, dtype=np.int64)]
+
+    def rel_only(self):
+        """
+        29-way codec of the relation model: every label but no_relation, indices starting from 0
+        """
+        return LabelCodec(
+            [label for label in self.labels if label != "no_relation"],
+            num_to_label=self.num_to_label,
+        )
+
+    def __call__(self, labels):
+        """
+        Convert in the direction of the dictionary the codec was loaded from
+        """
+        return self.decode(labels) if self.num_to_label else self.encode(labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+
+# binary label space of the no_rel model
+NO_REL_CODEC = LabelCodec(["relation", "no_relation"], num_to_label=True)
+
+
+@functools.lru_cache(maxsize=None)
+def load_label_codec(dictionary="data/dict_label_to_num.pkl"):
+    with open(dictionary, "rb") as f:
+        return LabelCodec.from_dict(pickle.load(f))
+
+
+Predictions = namedtuple("Predictions", ["id", "pred", "probs", "labels"])
+
+PREDICTION_DTYPES = {"float16": np.float16, "float32": np.float32}
+
+
+def save_predictions(file, ids, probs, labels, preds=None, dtype="float32"):
+    """
+    Binary prediction output (.npz): ids, predicted label indices, probs as a float16/float32
+    [N, num_labels] column and the label names, so it can be read back without a dictionary.
+    preds default to the argmax of probs
+    """
+    probs = np.asarray(probs)
+    if preds is None:
+        preds = probs.argmax(axis=-1)
+    np.savez(
+        file,
+        id=np.asarray(ids, dtype=np.int64),
+        pred=np.asarray(preds, dtype=np.int16),
+        probs=probs.astype(PREDICTION_DTYPES[dtype], copy=False),
+        labels=np.asarray(labels, dtype=str),
+    )
+
+
+def load_predictions(file):
+    with np.load(file) as f:
+        return Predictions(f["id"], f["pred"], f["probs"], f["labels"])
+
+
+def read_submission(file, labels):
+    """
+    Predictions from a submission csv, parsing the stringified probs without literal_eval
+    """
+    submission = pd.read_csv(file)
+    probs = np.array(submission["probs"].str[1:-1].str.split(",").tolist(), dtype=np.float32)
+    labels = np.asarray(labels, dtype=str)
+    preds = pd.Index(labels).get_indexer(submission["pred_label"])
+    return Predictions(submission["id"].to_numpy(), preds, probs, labels)
+
+
+def write_submission(file, ids, probs, labels, preds=None, chunk_size=100000):
+    """
+    Submission csv (id, pred_label, probs as a list string), written in chunks
+    so only chunk_size rows of probs are ever python lists
+    """
+    labels = np.asarray(labels, dtype=object)
+    ids = np.asarray(ids)
+    # range(0, 0) would write nothing, an empty prediction still gets its header
+    for start in range(0, max(len(probs), 1), chunk_size):
+        prob = np.asarray(probs[start: start + chunk_size])
+        pred = prob.argmax(axis=-1) if preds is None else np.asarray(preds[start: start + chunk_size])
+        output = pd.DataFrame({
+            "id": ids[start: start + chunk_size],
+            "pred_label": labels[pred],
+            "probs": prob.tolist(),
+        })
+        output.to_csv(file, index=False, mode="w" if start == 0 else "a", header=start == 0)
+
+
+def predictions_to_submission(file, submission):
+    predictions = load_predictions(file)
+    write_submission(submission, predictions.id, predictions.probs,
+                     predictions.labels, preds=predictions.pred)
+
+
 class ConfigParser:
     def __init__(self, config):
         self.config = self.json_to_dict(config)
@@ -19,31 +320,206 @@ class ConfigParser:
             return json.load(json_config)
 
 
+class TokenStore:
+    """
+    Tokenized sentences kept as one flat int32 token array plus per-row offsets
+    stores loaded from disk are memory-mapped: rows are zero-copy slices of the flat array
+    and pickling (e.g. for DataLoader workers) only sends the store directory
+    """
+
+    def __init__(self, input_ids, offsets, store_dir=None, entity_spans=None):
+        self.input_ids = input_ids
+        self.offsets = offsets
+        self.store_dir = store_dir
+        # optional [n, 4] e1_start, e1_end, e2_start, e2_end token positions for RBERT
+        self.entity_spans = entity_spans
+
+    @classmethod
+    def from_encoding(cls, encoding):
+        lengths = np.fromiter(
+            (len(ids) for ids in encoding["input_ids"]),
+            dtype=np.int64, count=len(encoding["input_ids"]),
+        )
+        input_ids = np.fromiter(
+            (token for ids in encoding["input_ids"] for token in ids),
+            dtype=np.int32, count=lengths.sum(),
+        )
+        return cls.from_lengths(input_ids, lengths)
+
+    @classmethod
+    def from_lengths(cls, input_ids, lengths):
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(input_ids, offsets)
+
+    @classmethod
+    def concat(cls, stores):
+        return cls.from_lengths(
+            np.concatenate([store.input_ids for store in stores]),
+            np.concatenate([store.lengths() for store in stores]),
+        )
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode="r"):
+        # plain ndarray views of the memmaps, slicing np.memmap itself is several times slower
+        return cls(
+            np.asarray(np.load(os.path.join(store_dir, "input_ids.npy"), mmap_mode=mmap_mode)),
+            np.asarray(np.load(os.path.join(store_dir, "offsets.npy"), mmap_mode=mmap_mode)),
+            store_dir=store_dir if mmap_mode else None,
+        )
+
+    def save(self, store_dir):
+        np.save(os.path.join(store_dir, "input_ids.npy"), self.input_ids)
+        np.save(os.path.join(store_dir, "offsets.npy"), self.offsets)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getstate__(self):
+        if self.store_dir is None:
+            return self.__dict__
+        return {"store_dir": self.store_dir, "entity_spans": self.entity_spans}
+
+    def __setstate__(self, state):
+        if "input_ids" not in state:
+            entity_spans = state["entity_spans"]
+            state = TokenStore.load(state["store_dir"]).__dict__
+            state["entity_spans"] = entity_spans
+        self.__dict__.update(state)
+
+    def __getitem__(self, idx):
+        # attention_mask is all ones before padding, DataCollatorWithPadding fills it in
+        item = {"input_ids": self.input_ids[self.offsets[idx]: self.offsets[idx + 1]]}
+        if self.entity_spans is not None:
+            item["entity_spans"] = self.entity_spans[idx]
+        return item
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class TokenizedCache:
+    """
+    Content-addressed on-disk cache of tokenized features
+    entries are TokenStore directories named by the hash of everything that shapes the tokens,
+    least recently used entries are evicted once the cache grows past max_bytes
+    """
+
+    def __init__(self, cache_dir="cache/tokenized", max_bytes=8 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, data, tokenizer, **settings):
+        vocab = sorted(tokenizer.get_vocab().items())
+        description = {
+            "version": 1,
+            "rows": hash_frame(data),
+            "columns": list(data.columns),
+            "tokenizer": type(tokenizer).__name__,
+            "name_or_path": tokenizer.name_or_path,
+            "vocab": hashlib.sha1(json.dumps(vocab).encode()).hexdigest(),
+            "settings": settings,
+        }
+        return hashlib.sha1(
+            json.dumps(description, sort_keys=True).encode()
+        ).hexdigest()
+
+    def load(self, key):
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return None
+        os.utime(entry)
+        return TokenStore.load(entry)
+
+    def save(self, key, store):
+        entry = os.path.join(self.cache_dir, key)
+        tmp = os.path.join(self.cache_dir, f".{key}.{os.getpid()}.tmp")
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            store.save(tmp)
+            os.replace(tmp, entry)
+        except OSError:
+            # another process already stored the same entry
+            if not os.path.isdir(entry):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+        return TokenStore.load(entry)
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)
+            )
+            entries.append((os.path.getmtime(entry), size, name, entry))
+
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, name, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
 class RelationExtractionDataset(Dataset):
     """
     A dataset class for loading Relation Extraction data
+    indices: optional row view (e.g. one fold) over the tokenized data and labels
     """
 
-    def __init__(self, data, labels=None):
+    def __init__(self, data, labels=None, indices=None):
+        if not isinstance(data, TokenStore) and set(data.keys()) <= {"input_ids", "attention_mask"}:
+            data = TokenStore.from_encoding(data)
         self.data = data
-        self.labels = labels
+        self.labels = None if labels is None else np.asarray(labels)
+        self.indices = None if indices is None else np.asarray(indices)
+
+    def select(self, indices):
+        indices = np.asarray(indices)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return RelationExtractionDataset(self.data, labels=self.labels, indices=indices)
 
     def __getitem__(self, idx):
-        item = {key: value[idx] for key, value in self.data.items()}
+        if self.indices is not None:
+            idx = self.indices[idx]
+        if isinstance(self.data, TokenStore):
+            item = self.data[idx]
+        else:
+            item = {key: value[idx] for key, value in self.data.items()}
         if self.labels is not None:
-            item["labels"] = torch.tensor(self.labels[idx])
+            item["labels"] = self.labels[idx]
         return item
 
     def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        if isinstance(self.data, TokenStore):
+            return len(self.data)
         return len(self.data["input_ids"])
 
+    def lengths(self):
+        if isinstance(self.data, TokenStore):
+            lengths = self.data.lengths()
+        else:
+            lengths = np.array([int(sum(mask)) for mask in self.data["attention_mask"]])
+        return lengths if self.indices is None else lengths[self.indices]
+
 
 class DataHelper:
     """
     A helper class for data loading and processing
     """
 
-    def __init__(self, data_dir, mode="train", add_ent_token=False, aug_data_dir=""):
+    def __init__(self, data_dir, mode="train", add_ent_token=False, add_data_dir="",
+                 cache_dir="cache/tokenized", num_workers=1):
 
         self._data = pd.read_csv(data_dir)
         if add_data_dir:
@@ -51,18 +527,14 @@ class DataHelper:
             self._data = pd.concat([self._data, self._aug_data])
         self._mode = mode
         self.add_ent_token = add_ent_token
+        self.cache = TokenizedCache(cache_dir) if cache_dir else None
+        self.num_workers = num_workers
         self._preprocess()
 
     def _preprocess(self):
         data = self._data
-        if self.add_ent_token:
-            data = self.ent_preprocess(data)
-
-        def extract(d):
-            return ast.literal_eval(d)["word"]
-
-        subjects = list(map(extract, data["subject_entity"]))
-        objects = list(map(extract, data["object_entity"]))
+        sentences, subjects, objects = self._preprocess_frame(data)
+        data["sentence"] = sentences
 
         self._processed = pd.DataFrame(
             {
@@ -73,7 +545,26 @@ class DataHelper:
             }
         )
         if self._mode == "train":
-            self._labels = self.convert_labels_by_dict(labels=data["label"])
+            self._labels = self._extract_labels(data)
+
+    def _extract_labels(self, data):
+        return self.convert_labels_by_dict(labels=data["label"])
+
+    def _preprocess_frame(self, data):
+        shards = shard(data, self.num_workers)
+        if len(shards) == 1:
+            return preprocess_frame(data, self.add_ent_token)
+
+        sentences, subjects, objects = [], [], []
+        columns = ["sentence", "subject_entity", "object_entity"]
+        with ProcessPoolExecutor(self.num_workers) as pool:
+            for shard_sentences, shard_subjects, shard_objects in pool.map(
+                preprocess_frame, [s[columns] for s in shards], [self.add_ent_token] * len(shards)
+            ):
+                sentences += shard_sentences
+                subjects += shard_subjects
+                objects += shard_objects
+        return sentences, subjects, objects
 
     def split(self, ratio=0.2, n_splits=5, mode="plain", random_seed=42):
         if mode == "plain":
@@ -89,6 +580,22 @@ class DataHelper:
             idxs_list = skf.split(self._processed, self._labels)
         return idxs_list
 
+    def fingerprint(self):
+        """
+        Hash of the preprocessed rows and labels, identifies the training data of a run
+        """
+        labels = self._labels.tobytes() if self._mode == "train" else b""
+        return hashlib.sha1(hash_frame(self._processed).encode() + labels).hexdigest()
+
+    def to_dataset(self, tokenizer):
+        """
+        Tokenize every row once, folds are then index views: dataset.select(train_idxs)
+        """
+        return RelationExtractionDataset(
+            self.tokenize(self._processed, tokenizer),
+            labels=self._labels if self._mode == "train" else None,
+        )
+
     def from_idxs(self, idxs=None):
         return (
             (self._processed.iloc[idxs], self._labels[idxs])
@@ -97,54 +604,56 @@ class DataHelper:
         )
 
     def tokenize(self, data, tokenizer):
-        concated_entities = [
-            sub + "[SEP]" + obj
-            for sub, obj in zip(data["subject_entity"], data["object_entity"])
-        ]
-        if self.add_ent_token:
-            tokenized = tokenizer(
-                data["sentence"].tolist(), truncation=True, return_token_type_ids=False,
-            )
-        else:
-            tokenized = tokenizer(
-                concated_entities,
-                data["sentence"].tolist(),
-                truncation=True,
-                return_token_type_ids=False,
+        """
+        Tokenize sentences (and entity pairs without entity tokens)
+        with a cache, returns a memory-mapped TokenStore that later runs reuse
+        """
+        if self.cache is None:
+            return self._tokenize(data, tokenizer)
+
+        key = self.cache.key(
+            data[["sentence", "subject_entity", "object_entity"]],
+            tokenizer,
+            add_ent_token=self.add_ent_token,
+            marker_scheme=MARKER_SCHEME if self.add_ent_token else "[SEP]",
+            truncation=True,
+            max_length=tokenizer.model_max_length,
+        )
+        store = self.cache.load(key)
+        if store is None:
+            store = self.cache.save(key, self._tokenize(data, tokenizer))
+        return store
+
+    def _tokenize(self, data, tokenizer):
+        shards = shard(data, self.num_workers)
+        if len(shards) == 1:
+            return TokenStore.from_encoding(tokenize_frame(data, tokenizer, self.add_ent_token))
+
+        columns = ["sentence", "subject_entity", "object_entity"]
+        with ProcessPoolExecutor(
+            self.num_workers, initializer=_init_tokenize_worker, initargs=(tokenizer,)
+        ) as pool:
+            stores = pool.map(
+                _tokenize_shard, [s[columns] for s in shards], [self.add_ent_token] * len(shards)
             )
-        return tokenized
+            return TokenStore.concat(list(stores))
 
     def convert_labels_by_dict(self, labels, dictionary="data/dict_label_to_num.pkl"):
-        with open(dictionary, "rb") as f:
-            dictionary = pickle.load(f)
-        return np.array([dictionary[label] for label in labels])
+        return load_label_codec(dictionary)(labels)
 
     def ent_preprocess(self, data):
-        data["sentence"] = data.apply(
-            lambda row: self.add_entity_tokens(
-                row["sentence"], row["object_entity"], row["subject_entity"]
-            ),
-            axis=1,
-        )
+        subjects = parse_entities(data["subject_entity"])
+        objects = parse_entities(data["object_entity"])
+        data["sentence"] = mark_entities(data["sentence"], subjects, objects)
         return data
 
     def add_entity_tokens(self, sentence, object_entity, subject_entity):
-        def entity_mapper(entity_type):
-            e_map = {
-                "PER": "인물",
-                "ORG": "기관",
-                "LOC": "지명",
-                "POH": "기타",
-                "DAT": "날짜",
-                "NOH": "수량",
-            }
-            return e_map[entity_type]
-
         def extract(entity):
+            entity = ast.literal_eval(entity)
             return (
-                int(ast.literal_eval(entity)["start_idx"]),
-                int(ast.literal_eval(entity)["end_idx"]),
-                entity_mapper(ast.literal_eval(entity)["type"]),
+                int(entity["start_idx"]),
+                int(entity["end_idx"]),
+                ENTITY_TYPES[entity["type"]],
             )
 
         obj_start_idx, obj_end_idx, obj_type = extract(object_entity)
@@ -192,59 +701,29 @@ class DataHelper:
     def tokenize_with_entity_mask(self, entity_data, tokenizer):
         """
         input sentence format : <e1> 이순신 </e1> 은 <e2> 조선 </e2> 중기의 무신이다.
+        output: TokenStore with entity_spans, batch with EntityMaskCollator to get e1_mask / e2_mask
         """
         tokenizer.add_special_tokens(
-            {"additional_special_tokens": ["<e1>", "</e1>", "<e2>", "</e2>"]}
+            {"additional_special_tokens": ENTITY_MASK_MARKERS}
         )
 
-        sub_start = tokenizer.vocab["<e1>"]
-        sub_end = tokenizer.vocab["</e1>"]
-        obj_start = tokenizer.vocab["<e2>"]
-        obj_end = tokenizer.vocab["</e2>"]
-
-        tokenized = tokenizer(
-            entity_data["sentence"].tolist(),
-            padding=True,
-            truncation=True,
-            return_token_type_ids=False,
-            return_tensors="pt",
+        tokenized = TokenStore.from_encoding(
+            tokenizer(
+                entity_data["sentence"].tolist(),
+                truncation=True,
+                return_token_type_ids=False,
+            )
         )
-
-        tokenized_to_check_idx = tokenizer(
-            entity_data["sentence"].tolist(),
-            padding=True,
-            truncation=True,
-            return_token_type_ids=False,
+        tokenized.entity_spans = find_entity_spans(
+            tokenized, tokenizer.convert_tokens_to_ids(ENTITY_MASK_MARKERS)
         )
-        e1_mask_list = []
-        e2_mask_list = []
-        for i in range(len(tokenized_to_check_idx["input_ids"])):
-            token_len = len(tokenized_to_check_idx["input_ids"][i])
-            e1_mask = [0] * token_len
-            e2_mask = [0] * token_len
-            sub_start_idx = tokenized_to_check_idx["input_ids"][i].index(
-                sub_start)
-            sub_end_idx = tokenized_to_check_idx["input_ids"][i].index(sub_end)
-            obj_start_idx = tokenized_to_check_idx["input_ids"][i].index(
-                obj_start)
-            obj_end_idx = tokenized_to_check_idx["input_ids"][i].index(obj_end)
-
-            for idx in range(sub_start_idx, sub_end_idx + 1):
-                e1_mask[idx] = 1
-
-            for idx in range(obj_start_idx, obj_end_idx + 1):
-                e2_mask[idx] = 1
-
-            e1_mask_list.append(e1_mask)
-            e2_mask_list.append(e2_mask)
-
-        tokenized["e1_mask"] = torch.LongTensor(e1_mask_list)
-        tokenized["e2_mask"] = torch.LongTensor(e2_mask_list)
 
         return tokenized
 
+
 class FixedDataHelper(DataHelper):
-    def __init__(self, train_data_dir, valid_data_dir, mode='train', add_ent_token=False, add_data_dir=''):
+    def __init__(self, train_data_dir, valid_data_dir, mode='train', add_ent_token=False, add_data_dir='',
+                 cache_dir='cache/tokenized', num_workers=1):
         _train_data = pd.read_csv(train_data_dir)
         _valid_data = pd.read_csv(valid_data_dir)
 
@@ -254,17 +733,14 @@ class FixedDataHelper(DataHelper):
 
         self._mode = mode
         self.add_ent_token = add_ent_token
+        self.cache = TokenizedCache(cache_dir) if cache_dir else None
+        self.num_workers = num_workers
         self.train_data, self.train_labels = self._preprocess(_train_data)
         self.valid_data, self.valid_labels = self._preprocess(_valid_data)
 
     def _preprocess(self, data):
-        if self.add_ent_token:
-            data = self.ent_preprocess(data)
-
-        def extract(d): return ast.literal_eval(d)['word']
-
-        subjects = list(map(extract, data['subject_entity']))
-        objects = list(map(extract, data['object_entity']))
+        sentences, subjects, objects = self._preprocess_frame(data)
+        data['sentence'] = sentences
 
         _processed = pd.DataFrame({
             'id': data['id'],